@@ -6,48 +6,94 @@
 
 
 
+import logging
 import threading
 import multiprocessing
-from functools import wraps
-from Queue import Queue, Empty
+from time import time
+from functools import wraps, partial
+from multiprocessing.sharedctypes import RawArray
+from multiprocessing.util import Finalize
+from itertools import islice
+from collections import deque
+from Queue import Queue, Empty, Full
 
-__all__ = ['process', 'thread']
+from structs import chunks
 
 
-def process(*proxy_args, **proxy_kwargs):
+log = logging.getLogger(__name__)
 
-    fire = proxy_kwargs.pop('fire', False) or proxy_args or proxy_kwargs
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
 
-    def decorator(func):
+try:
+    from concurrent.futures import Future
+except ImportError:
+    Future = None
 
-        if fire:
+__all__ = ['process', 'thread', 'TaskResult', 'ResultTimeout', 'worker',
+           'WorkerPool', 'WorkerDied', 'pmap', 'pimap', 'SharedMemoryChannel',
+           'aio_worker', 'AsyncWorker']
 
-            @wraps(func)
-            def fun(*args, **kwargs):
-                func(*args, **kwargs)
 
-            fun.process = multiprocessing.Process(target=fun, args=proxy_args,
-                                                   kwargs=proxy_kwargs)
-            fun.process.start()
+def process(*proxy_args, **proxy_kwargs):
+    """
+        Make the decorated function run in another process. Calling it
+        returns a TaskResult right away:
 
-            return fun
+            @process()
+            def compute(x):
+                return x * 2
 
-        else:
+            res = compute(21)
+            print res.result(timeout=10)
 
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                process = multiprocessing.Process(target=func, args=args,
-                                                  kwargs=kwargs)
-                process.start()
-                return process
+        Calls are sent to a pool of `pool_size` processes (it defaults
+        to the number of CPUs), started on the first call and reused for
+        the next ones. The arguments and the return value must be
+        picklable.
 
-            return wrapper
+        The processes are not daemons, so the function can start processes
+        itself. When the program exits, it waits for the pending calls,
+        then stops the pool. If it's killed instead, the pool processes
+        are left waiting for calls, so kill them too.
 
-    return decorator
+        If you pass arguments to the decorator, the function is called
+        right away with them, in a pool of one process, and the TaskResult
+        is available as `func.process`:
+
+            @process(21)
+            def compute(x):
+                return x * 2
+
+            print compute.process.result()
+
+        The `pool_size` and `fire` keyword arguments are for the decorator,
+        so they are not passed to the function.
+    """
+    return pooled('process', proxy_args, proxy_kwargs)
 
 
 def thread(*proxy_args, **proxy_kwargs):
+    """
+        Same as process(), but with threads. `pool_size` defaults to 5
+        times the number of CPUs, and the TaskResult of a fired function is
+        available as `func.thread`.
+
+        The threads are daemons, since Python waits for the other threads
+        before it runs the exit handlers stopping the pool. But the program
+        still waits for the pending calls before exiting.
+    """
+    return pooled('thread', proxy_args, proxy_kwargs)
+
+
+def pooled(method, proxy_args, proxy_kwargs):
 
+    size = proxy_kwargs.pop('pool_size', None)
     fire = proxy_kwargs.pop('fire', False) or proxy_args or proxy_kwargs
 
     def decorator(func):
@@ -58,20 +104,21 @@ def thread(*proxy_args, **proxy_kwargs):
             def fun(*args, **kwargs):
                 func(*args, **kwargs)
 
-            fun.thread = threading.Thread(target=fun, args=proxy_args,
-                                           kwargs=proxy_kwargs)
-            fun.thread.start()
+            # a single call, there is no need for more
+            setattr(fun, method, CallPool(func, method, 1).submit(
+                    proxy_args, proxy_kwargs))
 
             return fun
 
         else:
 
+            pool = CallPool(func, method, size)
+
             @wraps(func)
             def wrapper(*args, **kwargs):
-                thread = threading.Thread(target=func, args=args,
-                                          kwargs=kwargs)
-                thread.start()
-                return thread
+                return pool.submit(args, kwargs)
+
+            wrapper.pool = pool
 
             return wrapper
 
@@ -82,7 +129,802 @@ class StopWorker():
     pass
 
 
-def worker(block=True, timeout=0.1, method='process'):
+class WorkerDied(Exception):
+    """
+        Returned as a result by a supervised WorkerPool for an item which
+        was being processed when its worker died more than `max_retries`
+        times.
+    """
+    pass
+
+
+# Sentinel telling a method to use the value the pool was created with
+DEFAULT = object()
+
+
+# Layout of the stats counters of one worker: number of items processed,
+# number of errors, then a histogram of latencies with buckets of
+# [2 ** (n - 1), 2 ** n[ microseconds
+PROCESSED, ERRORS, LATENCIES = range(3)
+LATENCY_BUCKETS = 40
+STATS_ROW_SIZE = LATENCIES + LATENCY_BUCKETS
+
+
+def latency_percentile(histogram, percent):
+    """
+        Return the upper bound, in seconds, of the histogram bucket
+        containing the given percentile.
+    """
+    total = sum(histogram)
+    if not total:
+        return 0.
+
+    threshold = total * percent / 100.
+    seen = 0
+    for bucket, number in enumerate(histogram):
+        seen += number
+        if seen >= threshold:
+            return (2 ** bucket) / 1000000.
+
+
+def qsize(queue):
+    """
+        Queue.qsize() or None if the plateform doesn't support it.
+    """
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+
+
+class PipeQueue(object):
+    """
+        Minimal queue for several processes writing to one reader, on top
+        of a Pipe. Unlike multiprocessing.Queue, put() writes the data
+        in the pipe before returning instead of leaving it to a thread, so
+        it's not lost if the process is killed right after.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = multiprocessing.Pipe(False)
+        self.lock = multiprocessing.Lock()
+
+    def put(self, obj, block=True, timeout=None):
+        with self.lock:
+            self.writer.send(obj)
+
+    def get(self, block=True, timeout=None):
+        if not self.reader.poll(timeout if block else 0):
+            raise Empty
+        return self.reader.recv()
+
+    def qsize(self):
+        raise NotImplementedError()
+
+
+
+class SharedBuffer(object):
+    """
+        Handle on a slot of a SharedMemoryChannel. This is what is sent
+        through the queue instead of the data.
+    """
+
+    def __init__(self, slot, size):
+        self.slot = slot
+        self.size = size
+
+
+
+class SharedMemoryChannel(object):
+    """
+        Shared memory arena, split in `slots` slots of `slot_size` bytes,
+        to pass big binary results from worker processes without pickling
+        them.
+
+        It must be created before the processes are started, so they
+        inherit it when forking.
+
+        The worker calls dump() on its result: if it's a str, a bytearray
+        or a memoryview between `threshold` and `slot_size` bytes, it is
+        copied in a free slot and a SharedBuffer is returned instead.
+        Anything else is returned as-is and goes through the queue the usual
+        way. If there is no free slot, the worker waits for one.
+
+        The parent calls load() on what it receives, and gets a memoryview
+        on the slot. It is not a copy: the slot can't be reused until you
+        call release() on this memoryview, after what its content may
+        change at any time.
+
+        Binary data with items bigger than one byte, like arrays, is turned
+        to bytes first, so use something like numpy.frombuffer() on the
+        memoryview to get your array back.
+    """
+
+    def __init__(self, slots=8, slot_size=4 * 1024 * 1024,
+                 threshold=64 * 1024):
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self.threshold = threshold
+
+        self.array = RawArray('c', slots * slot_size)
+        self.view = memoryview(self.array)
+        self.free_slots = multiprocessing.Queue()
+        for slot in xrange(slots):
+            self.free_slots.put(slot)
+
+        self.leases = {}  # id(memoryview) -> (slot, memoryview)
+
+
+    def dump(self, obj):
+
+        if not isinstance(obj, (str, bytearray, memoryview)):
+            return obj
+
+        if isinstance(obj, memoryview) and obj.itemsize != 1:
+            obj = obj.tobytes()
+
+        size = len(obj)
+        if not self.threshold <= size <= self.slot_size:
+            return obj
+
+        slot = self.free_slots.get()
+        start = slot * self.slot_size
+        self.view[start:start + size] = obj
+        return SharedBuffer(slot, size)
+
+
+    def load(self, obj):
+
+        if not isinstance(obj, SharedBuffer):
+            return obj
+
+        start = obj.slot * self.slot_size
+        view = self.view[start:start + obj.size]
+        self.leases[id(view)] = (obj.slot, view)
+        return view
+
+
+    def release(self, view):
+        """
+            Make the slot behind this memoryview available again. Noop
+            if the memoryview is not from this channel.
+        """
+        slot, view = self.leases.pop(id(view), (None, None))
+        if slot is not None:
+            self.free_slots.put(slot)
+
+
+
+class WorkerPool(object):
+    """
+        Run a function in one or several processes (or threads) sharing the
+        same input queue. This is what the `worker` decorator creates, but
+        you can use it directly:
+
+            pool = WorkerPool(lambda x: x * 2, size=4).start()
+
+            for x in range(10):
+                pool.put(x)
+
+            for x in range(10):
+                print pool.get()
+
+            pool.stop()
+
+        Every item is tagged with its submission index before being sent
+        to the workers, and results come back with the same tag. By default
+        `get()` returns the results as they are completed, but with
+        `ordered=True` it returns them in the order the items were submitted,
+        buffering the ones that arrived too early.
+
+        `put()` returns the index of the submitted item, and `get(tagged=True)`
+        returns (index, result) so you can match them yourself.
+
+        If you set `maxsize`, both input and output queues are bounded: put()
+        will block (or raise Queue.Full once `timeout` is expired) when the
+        workers can't keep up, and workers will block when nobody consumes
+        the results. Don't use a small maxsize with `ordered=True` if you
+        don't call get() regularly, as the results the pool is waiting for
+        may be stuck behind the ones in the queue.
+
+        Sending a lot of small items is dominated by the cost of the queue
+        itself, so you can set `batch_size` to send items and results by
+        chunks of that size. A chunk is sent when it's full, or when it's
+        older than `batch_timeout` seconds. On the producer side, this
+        is only checked when you call put(), so call flush() if you stop
+        producing for a while. get() and stop() flush automatically.
+
+        put_many() and get_many() let you send and receive a bunch of items
+        at once:
+
+            pool = WorkerPool(lambda x: x * 2, batch_size=1000).start()
+            pool.put_many(xrange(100000))
+            results = pool.get_many(100000)
+
+        Note that maxsize counts chunks, not items.
+
+        Results go through a multiprocessing.Queue, which pickles them. For
+        big binary results, pass `shared_memory=True` (or your own
+        SharedMemoryChannel) to write them in shared memory instead, and
+        get() will return a memoryview on it. Call release() on it once you
+        are done so the memory can be reused:
+
+            pool = WorkerPool(render_image, shared_memory=True).start()
+            pool.put(data)
+            image = pool.get(timeout=None)
+            save(image)
+            pool.release(image)
+
+        Call stats() to know what's going on in the pool: how many workers
+        are alive, queues length, items processed, errors, throughput and
+        latency percentiles. Latencies are measured by the workers and
+        aggregated in a log2 histogram, so percentiles are an upper bound,
+        precise within a factor of 2.
+
+        Pass `stats_hook`, a callable, to have it called with stats() every
+        `stats_interval` seconds, from a thread, until the workers are
+        stopped:
+
+            pool = WorkerPool(task, size=4, stats_hook=logger.info).start()
+
+        If a worker process dies (segfault, OOM killer...), the items it
+        was processing are lost and get() will wait for them forever. With
+        `supervise=True`, a thread checks the workers every
+        `supervise_interval` seconds, starts a new one in place of any
+        dead one and sends its items to the queue again. An item which
+        was being processed when its worker died more than `max_retries`
+        times is returned as a WorkerDied exception instead.
+
+        In this mode, workers send their results through a PipeQueue,
+        which writes them before moving on, so results already sent by a
+        worker can't die with it. `maxsize` doesn't apply to the results
+        then.
+
+        It's best effort: the pool keeps every item until you get() its
+        result, and the same item may be processed twice (only one result
+        is returned). Items sent again while the pool is being stopped are
+        not processed, since they are queued after the StopWorker. A
+        process killed while it writes in a queue may leave it corrupted,
+        or locked for the others, which no supervisor can fix.
+
+        stop() just asks the workers to exit once they processed the items
+        already in the queue. Use stop(drain=True) to wait for them to do
+        so, up to `timeout` seconds.
+    """
+
+    def __init__(self, func, size=1, method='process', block=True,
+                 timeout=0.1, maxsize=0, ordered=False, batch_size=1,
+                 batch_timeout=0.1, shared_memory=None, stats_hook=None,
+                 stats_interval=10, supervise=False, max_retries=3,
+                 supervise_interval=0.5, daemon=False):
+
+        if method == 'thread':
+            Q = Queue
+            self.Manager = threading.Thread
+        else:
+            Q = multiprocessing.Queue
+            self.Manager = multiprocessing.Process
+
+        self.func = func
+        self.size = size
+        self.method = method
+        self.block = block
+        self.timeout = timeout
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+        if shared_memory is True:
+            shared_memory = SharedMemoryChannel()
+        self.shared_memory = shared_memory
+
+        self.in_queue = Q(maxsize)
+        if supervise and method != 'thread':
+            self.out_queue = PipeQueue()
+        else:
+            self.out_queue = Q(maxsize)
+
+        self.batch = []         # items waiting to be sent as one chunk
+        self.batch_started = 0
+        # self.submitted is also the index of the next item, and can be
+        # given back if the item can't be queued, so we need a lock
+        self.put_lock = threading.RLock()
+        self.results = deque()  # results received but not yet returned
+        self.next_index = 0     # next result expected in ordered mode
+        self.early_results = {}
+
+        # Each worker writes its counters in its own row so we need no lock
+        self.counters = RawArray('L', size * STATS_ROW_SIZE)
+        self.busy_time = RawArray('d', size)
+        self.submitted = 0      # number of items put, so far
+        self.started = None
+        self.stats_hook = stats_hook
+        self.stats_interval = stats_interval
+        self.stopped = threading.Event()
+        self.reporter = None
+
+        # A worker flags itself when it exits on purpose, so we can tell
+        # it apart from a dead one
+        self.exited = RawArray('b', size)
+        self.supervise = supervise
+        self.max_retries = max_retries
+        self.supervise_interval = supervise_interval
+        self.daemon = daemon
+        self.supervisor = None
+        self.restarts = 0
+        if supervise:
+            self.pending = {}   # items for which we have no result yet
+            self.retries = {}
+            # indexes of the batch each worker is processing, and the
+            # position in this batch of the item being processed
+            self.claims = RawArray('l', size * batch_size)
+            self.claimed = RawArray('l', size)
+            self.progress = RawArray('l', size)
+        else:
+            self.claims = None
+
+        self.managers = [self.create_manager(x) for x in xrange(size)]
+
+
+    def create_manager(self, worker_id):
+        manager = self.Manager(target=self.main_loop, args=(worker_id,))
+        manager.daemon = self.daemon
+        return manager
+
+
+    def main_loop(self, worker_id=0):
+
+        in_queue = self.in_queue
+        out_queue = self.out_queue
+        func = self.func
+        batch_size = self.batch_size
+        batch_timeout = self.batch_timeout
+        shared_memory = self.shared_memory
+        counters = self.counters
+        busy_time = self.busy_time
+        row = worker_id * STATS_ROW_SIZE
+        last_bucket = LATENCY_BUCKETS - 1
+        claims = self.claims
+        claims_start = worker_id * batch_size
+
+        while True:
+            try:
+
+                # Block until there is something to do instead of polling:
+                # stop() sends a StopWorker through the same queue, so we
+                # can't miss it, and an idle worker costs nothing.
+                msg = in_queue.get()
+
+                if isinstance(msg, StopWorker):
+                    break
+
+                if claims is not None:
+                    for i, (index, item) in enumerate(msg):
+                        claims[claims_start + i] = index
+                    self.claimed[worker_id] = len(msg)
+
+                results = []
+                started = time()
+
+                for position, (index, item) in enumerate(msg):
+
+                    if claims is not None:
+                        self.progress[worker_id] = position
+
+                    item_started = time()
+
+                    try:
+                        res = func(item)
+                        if shared_memory is not None:
+                            res = shared_memory.dump(res)
+                        results.append((index, res))
+                    except Exception as e:
+                        results.append((index, e))
+                        counters[row + ERRORS] += 1
+
+                    duration = time() - item_started
+                    busy_time[worker_id] += duration
+                    counters[row + PROCESSED] += 1
+                    bucket = int(duration * 1000000).bit_length()
+                    counters[row + LATENCIES + min(bucket, last_bucket)] += 1
+
+                    if (len(results) >= batch_size or
+                       time() - started > batch_timeout):
+                        out_queue.put(results)
+                        results = []
+                        started = time()
+
+                if results:
+                    out_queue.put(results)
+
+                if claims is not None:
+                    self.claimed[worker_id] = 0
+
+            except KeyboardInterrupt:
+                break
+
+        self.exited[worker_id] = 1
+
+
+    def start(self):
+        self.started = time()
+        for manager in self.managers:
+            manager.start()
+        if self.stats_hook is not None:
+            self.reporter = threading.Thread(target=self.report_stats)
+            self.reporter.daemon = True
+            self.reporter.start()
+        if self.supervise:
+            self.supervisor = threading.Thread(target=self.supervise_workers)
+            self.supervisor.daemon = True
+            self.supervisor.start()
+        return self
+
+
+    def report_stats(self):
+        while not self.stopped.wait(self.stats_interval):
+            self.stats_hook(self.stats())
+            if all(self.exited):
+                break
+
+
+    def supervise_workers(self):
+        while not self.stopped.wait(self.supervise_interval):
+            for worker_id, manager in enumerate(self.managers):
+                if not manager.is_alive() and not self.exited[worker_id]:
+                    self.restart(worker_id)
+            if all(self.exited):
+                break
+
+
+    def restart(self, worker_id):
+        """
+            Replace a dead worker and send its items to the queue again.
+        """
+
+        dead = self.managers[worker_id]
+        claims_start = worker_id * self.batch_size
+        lost = self.claims[claims_start:claims_start + self.claimed[worker_id]]
+        culprit = lost[self.progress[worker_id]] if lost else None
+        self.claimed[worker_id] = 0
+
+        manager = self.create_manager(worker_id)
+        self.managers[worker_id] = manager
+        manager.start()
+        self.restarts += 1
+
+        retry = []
+        for index in lost:
+            item = self.pending.get(index, DEFAULT)
+            if item is DEFAULT:  # we already got the result
+                continue
+            if index == culprit:
+                retries = self.retries[index] = self.retries.get(index, 0) + 1
+                if retries > self.max_retries:
+                    error = WorkerDied('Item %s killed its worker %s times '
+                                       '(last exit code: %s)' % (index,
+                                       retries, getattr(dead, 'exitcode', None)))
+                    self.out_queue.put([(index, error)])
+                    continue
+            retry.append((index, item))
+
+        if retry:
+            self.in_queue.put(retry)
+
+
+    def stats(self):
+        """
+            Return a dict of metrics about the pool.
+        """
+
+        counters = self.counters[:]
+        workers = range(self.size)
+
+        processed = sum(counters[w * STATS_ROW_SIZE + PROCESSED]
+                        for w in workers)
+        errors = sum(counters[w * STATS_ROW_SIZE + ERRORS] for w in workers)
+        histogram = [sum(counters[w * STATS_ROW_SIZE + LATENCIES + b]
+                         for w in workers)
+                     for b in xrange(LATENCY_BUCKETS)]
+
+        elapsed = time() - self.started if self.started else 0
+        busy_time = sum(self.busy_time)
+
+        return {
+            'workers': self.size,
+            'alive': sum(1 for m in self.managers if m.is_alive()),
+            'exitcodes': [getattr(m, 'exitcode', None) for m in self.managers],
+            'restarts': self.restarts,
+            'submitted': self.submitted,
+            'processed': processed,
+            'errors': errors,
+            'in_queue': qsize(self.in_queue),
+            'out_queue': qsize(self.out_queue),
+            'throughput': processed / elapsed if elapsed else 0.,
+            'latency': {
+                'mean': busy_time / processed if processed else 0.,
+                'p50': latency_percentile(histogram, 50),
+                'p90': latency_percentile(histogram, 90),
+                'p99': latency_percentile(histogram, 99),
+            }
+        }
+
+
+    def flush(self, block=DEFAULT, timeout=DEFAULT):
+        """
+            Send the items waiting in the current batch right away.
+
+            If the queue is full, they stay in the batch for the next try.
+        """
+        block = self.block if block is DEFAULT else block
+        timeout = self.timeout if timeout is DEFAULT else timeout
+        with self.put_lock:
+            if self.batch:
+                self.send(self.batch, block, timeout)
+                self.batch = []
+
+
+    def send(self, batch, block, timeout):
+        """
+            Put a chunk of (index, item) in the queue.
+        """
+        # Results are only returned for pending items, so they must be
+        # recorded before a worker can get them
+        if self.supervise:
+            self.pending.update(batch)
+        try:
+            self.in_queue.put(batch, block, timeout)
+        except Full:
+            if self.supervise:
+                for index, item in batch:
+                    del self.pending[index]
+            raise
+
+
+    def put(self, item, block=DEFAULT, timeout=DEFAULT):
+        """
+            Send an item to the workers and return its submission index.
+
+            If the queue is full, Queue.Full is raised and the item is not
+            submitted: its index will be used by the next one.
+        """
+        with self.put_lock:
+            index = self.submitted
+            self.submitted = index + 1
+
+            batch = self.batch
+            if not batch:
+                self.batch_started = time()
+            batch.append((index, item))
+
+            if (len(batch) >= self.batch_size or
+               time() - self.batch_started > self.batch_timeout):
+                try:
+                    self.flush(block, timeout)
+                except Full:
+                    # the ordered mode would wait for this index forever
+                    batch.pop()
+                    self.submitted = index
+                    raise
+
+            return index
+
+
+    def put_many(self, items, block=DEFAULT, timeout=DEFAULT,
+                 batch_size=None):
+        """
+            Send all items to the workers, by chunks of `batch_size`
+            (which defaults to the one of the pool), and return the list
+            of their submission indexes.
+
+            If the queue is full, the chunks already sent are processed,
+            but the items of the next ones are not submitted.
+        """
+        block = self.block if block is DEFAULT else block
+        timeout = self.timeout if timeout is DEFAULT else timeout
+        batch_size = batch_size or self.batch_size
+        if self.supervise:
+            # workers can't claim more than that
+            batch_size = min(batch_size, self.batch_size)
+
+        indexes = []
+        with self.put_lock:
+            self.flush(block, timeout)
+            for chunk in chunks(items, batch_size, list):
+                start = self.submitted
+                self.send(list(enumerate(chunk, start)), block, timeout)
+                self.submitted = start + len(chunk)
+                indexes.extend(xrange(start, self.submitted))
+
+        return indexes
+
+
+    def try_flush(self):
+        """
+            Send the current batch if the queue has room for it. Otherwise,
+            the workers are busy so results are coming, and we'll try again
+            when we get them.
+        """
+        try:
+            self.flush(False)
+        except Full:
+            pass
+
+
+    def receive(self, block, timeout):
+        """
+            Get the next chunk of results from the workers.
+        """
+        # we would wait forever for items still in our own buffer
+        self.try_flush()
+
+        results = self.out_queue.get(block, timeout)
+
+        if self.supervise:
+            # an item may have been processed twice, return it only once
+            pending = self.pending
+            results = [(index, res) for index, res in results
+                       if pending.pop(index, DEFAULT) is not DEFAULT]
+            for index, res in results:
+                self.retries.pop(index, None)
+
+        return results
+
+
+    def get(self, block=DEFAULT, timeout=DEFAULT, tagged=False):
+        """
+            Return the next result, or raise it if it's an exception.
+        """
+        block = self.block if block is DEFAULT else block
+        timeout = self.timeout if timeout is DEFAULT else timeout
+        index, res = self.next_result(block, timeout)
+        return self.unpack(index, res, tagged)
+
+
+    def next_result(self, block, timeout):
+        """
+            Return the next (index, result) pair, as sent by the workers.
+        """
+
+        self.try_flush()
+
+        results = self.results
+
+        # in ordered mode, results only holds the ones get_many() gave back
+        if self.ordered and not results:
+            early_results = self.early_results
+            while self.next_index not in early_results:
+                early_results.update(self.receive(block, timeout))
+            index = self.next_index
+            self.next_index += 1
+            return index, early_results.pop(index)
+
+        while not results:
+            results.extend(self.receive(block, timeout))
+        return results.popleft()
+
+
+    def unpack(self, index, res, tagged):
+        if isinstance(res, Exception):
+            raise res
+
+        if self.shared_memory is not None:
+            res = self.shared_memory.load(res)
+
+        if tagged:
+            return index, res
+        return res
+
+
+    def get_many(self, number, block=DEFAULT, timeout=DEFAULT, tagged=False):
+        """
+            Return a list of the next `number` results.
+
+            If one of them is an exception, it is raised, and the other
+            results are kept for the next call. Same thing if we time out.
+        """
+        block = self.block if block is DEFAULT else block
+        timeout = self.timeout if timeout is DEFAULT else timeout
+
+        pairs = []
+        try:
+            for x in xrange(number):
+                index, res = self.next_result(block, timeout)
+                if isinstance(res, Exception):
+                    raise res
+                pairs.append((index, res))
+        except Exception:
+            self.results.extendleft(reversed(pairs))
+            raise
+
+        unpack = self.unpack
+        return [unpack(index, res, tagged) for index, res in pairs]
+
+
+    def release(self, view):
+        """
+            Give back the shared memory used by a result.
+        """
+        self.shared_memory.release(view)
+
+
+    def stop(self, drain=False, timeout=None):
+        """
+            Ask the workers to exit once the items already sent are
+            processed. With `drain=True`, wait for them to do so, up to
+            `timeout` seconds, including the time to queue the StopWorker
+            if the queue is full.
+        """
+        if not drain:
+            self.flush()
+            for manager in self.managers:
+                self.in_queue.put(StopWorker(), self.block, self.timeout)
+            return
+
+        deadline = None if timeout is None else time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time())
+
+        self.flush(True, remaining())
+        for manager in self.managers:
+            self.in_queue.put(StopWorker(), True, remaining())
+        self.join(remaining())
+
+
+    def join(self, timeout=None):
+        """
+            Wait for the workers to exit, then stop the stats and supervisor
+            threads.
+        """
+
+        deadline = None if timeout is None else time() + timeout
+
+        for worker_id in xrange(self.size):
+            while True:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - time())
+                self.managers[worker_id].join(remaining)
+                # a dead worker is about to be replaced by the supervisor
+                if (not self.supervise or self.exited[worker_id] or
+                   self.stopped.is_set() or remaining == 0):
+                    break
+                self.stopped.wait(self.supervise_interval)
+
+        if not self.is_alive():
+            self.stop_threads()
+
+
+    def stop_threads(self):
+        self.stopped.set()
+        for thread in (self.reporter, self.supervisor):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+
+
+    def is_alive(self):
+        return any(manager.is_alive() for manager in self.managers)
+
+
+    def terminate(self):
+        """
+            Kill the worker processes. Threads can't be killed, so this
+            is a noop for them.
+        """
+        self.stop_threads()
+        for manager in self.managers:
+            if hasattr(manager, 'terminate'):
+                manager.terminate()
+
+
+
+def worker(block=True, timeout=0.1, method='process', size=1, maxsize=0,
+           ordered=False, batch_size=1, batch_timeout=0.1,
+           shared_memory=None, stats_hook=None, stats_interval=10,
+           supervise=False, max_retries=3, supervise_interval=0.5):
     """
         Turn a function into a worker:
 
@@ -129,54 +971,500 @@ def worker(block=True, timeout=0.1, method='process'):
         If an exception occures, it will be send back in the message queue.
 
         So you may want to check the result with isintance().
+
+        By default there is only one process, consuming one item at a time.
+        For CPU bound tasks, you can use a pool of processes sharing
+        the same input queue instead:
+
+            @worker(size=4, maxsize=1000, ordered=True)
+            def test(mot):
+                return mot
+
+        If you have a lot of small items, send them by chunks:
+
+            @worker(batch_size=1000)
+            def test(mot):
+                return mot
+
+            process = test.start()
+            process.put_many(range(100000))
+            print process.get_many(100000)
+
+        See WorkerPool for the meaning of all the parameters.
     """
 
     def decorator(func):
 
-        if method == 'thread':
-            Q = Queue
-            Manager = threading.Thread
-        else:
-            Q = multiprocessing.Queue
-            Manager = multiprocessing.Process
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
 
-        in_queue = Q()
-        out_queue = Q()
+        wrapper.manager = WorkerPool(func, size, method, block, timeout,
+                                     maxsize, ordered, batch_size,
+                                     batch_timeout, shared_memory, stats_hook,
+                                     stats_interval, supervise, max_retries,
+                                     supervise_interval)
+        wrapper.start = wrapper.manager.start
 
-        def main_loop():
+        return wrapper
+
+    return decorator
 
-            while True:
-                try:
 
-                    res = in_queue.get(block, timeout)
 
-                    if isinstance(res, StopWorker):
-                        break
+def pimap(func, iterable, size=None, method='process', ordered=True,
+          chunksize=None, max_chunksize=1024, buffersize=None):
+    """
+        Apply `func` to every item of `iterable` using a pool of `size`
+        processes (or threads with method='thread'), and return a
+        generator yielding the results:
+
+            from batbelt.parallel import pimap
+
+            for res in pimap(lambda x: x * 2, xrange(1000000)):
+                print res
+
+        The iterable is consumed lazily, and there are never more than
+        `buffersize` items being processed or waiting to be yielded, so
+        memory stays bounded no matter how big the input is. It
+        defaults to twice what the pool can get in one round of chunks.
+
+        `size` defaults to the number of CPUs. With `ordered=False`,
+        results are yielded as soon as they are ready instead of in the
+        order of the input.
+
+        Items are dispatched by chunks to limit the cost of communications.
+        If you don't set `chunksize`, it starts at 1 and is adjusted on the
+        fly so that each chunk represents about 50ms of work for one worker,
+        up to `max_chunksize` items.
 
-                    out_queue.put(func(res))
+        If `func` raises an exception, it's raised by the generator and
+        the pool is stopped.
+    """
+
+    size = size or multiprocessing.cpu_count()
+    max_chunksize = chunksize or max_chunksize
+    buffersize = buffersize or size * max_chunksize * 2
+
+    pool = WorkerPool(func, size, method, ordered=ordered,
+                      batch_size=max_chunksize).start()
 
-                except Empty:
-                    pass
-                except KeyboardInterrupt:
+    items = iter(iterable)
+    exhausted = False
+    in_flight = 0
+    done = 0
+    current_chunksize = chunksize or 1
+    started = time()
+
+    try:
+        while True:
+
+            while not exhausted and in_flight < buffersize:
+                batch = list(islice(items, current_chunksize))
+                if not batch:
+                    exhausted = True
                     break
-                except Exception as e:
-                    out_queue.put(e)
+                pool.put_many(batch, True, None, len(batch))
+                in_flight += len(batch)
+
+            if not in_flight:
+                break
+
+            yield pool.get(True, None)
+            in_flight -= 1
+            done += 1
+
+            if chunksize is None:
+                elapsed = time() - started
+                if elapsed:
+                    # items per second per worker * 50ms
+                    guess = int(done / elapsed / size * 0.05)
+                    current_chunksize = max(1, min(max_chunksize, guess))
+
+    finally:
+        # the caller didn't consume everything: don't wait for the rest
+        if in_flight:
+            pool.terminate()
+        pool.stop()
+        pool.join()
+
+
+def pmap(func, iterable, size=None, method='process', ordered=True,
+         chunksize=None, max_chunksize=1024, buffersize=None):
+    """
+        Same as pimap, but returns a list.
+    """
+    return list(pimap(func, iterable, size, method, ordered, chunksize,
+                      max_chunksize, buffersize))
+
+
+
+class ResultTimeout(Exception):
+    pass
+
+
+
+class TaskResult(object):
+    """
+        Handle on the result of a call to a function decorated with
+        @process or @thread.
+
+        result() waits for the return value and returns it, or raises
+        the exception raised by the function. Callbacks registered with
+        add_done_callback() are called with the TaskResult as soon as it's
+        done, from the thread dispatching the results, or right away if
+        it's already done. Like with concurrent.futures, exceptions they
+        raise are logged and ignored.
+    """
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+
+
+    def done(self):
+        return self.finished.is_set()
+
+
+    def wait(self, timeout=None):
+        """
+            Wait for the call to be done. Return False if it's not after
+            `timeout` seconds.
+        """
+        return self.finished.wait(timeout)
+
+    # Compat with the Process / Thread objects returned by older versions
+    join = wait
+
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise ResultTimeout('No result after %s seconds' % timeout)
+        return self.error
+
+
+    def result(self, timeout=None):
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self.value
+
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        self.run_callback(callback)
+
+
+    def run_callback(self, callback):
+        # don't let a broken callback kill the dispatcher thread
+        try:
+            callback(self)
+        except Exception:
+            log.exception('Exception in callback %r of %r', callback, self)
+
+
+    def set(self, value=None, error=None):
+        with self.lock:
+            self.value = value
+            self.error = error
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            self.run_callback(callback)
+
+
+
+class CallPool(object):
+    """
+        WorkerPool running the calls of a function decorated with @process or
+        @thread, and dispatching the results to TaskResult objects.
+    """
+
+    def __init__(self, func, method='process', size=None):
+
+        if size is None:
+            size = multiprocessing.cpu_count()
+            if method == 'thread':
+                size *= 5
+
+        self.func = func
+        # Python joins the threads before running the exit hooks, so
+        # threads must be daemons for stop() to be called
+        self.pool = WorkerPool(self.call, size, method,
+                               daemon=(method == 'thread'))
+        self.results = {}
+        self.lock = threading.Lock()
+        self.dispatcher = None
+
+
+    def call(self, item):
+        args, kwargs = item
+        return self.func(*args, **kwargs)
+
+
+    def start(self):
+        self.pool.start()
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        # Unlike atexit, it's also run when a multiprocessing child exits,
+        # and before waiting for the pool processes. The priority must be
+        # higher than the one of the queues (10), which stops their threads.
+        Finalize(self, self.pool.stop, args=(True,), exitpriority=100)
+
+
+    def submit(self, args, kwargs):
+        result = TaskResult()
+        with self.lock:
+            if self.dispatcher is None:
+                self.start()
+            index = self.pool.put((args, kwargs), True, None)
+            self.results[index] = result
+        return result
+
+
+    def dispatch(self):
+        while True:
+            for index, res in self.pool.receive(True, None):
+                with self.lock:
+                    result = self.results.pop(index)
+                if isinstance(res, Exception):
+                    result.set(error=res)
+                else:
+                    result.set(res)
+
+
+
+class AsyncWorker(object):
+    """
+        Run a coroutine function on the items you send it, with at most
+        `concurrency` of them running at the same time, all in the same
+        thread. This is what the `aio_worker` decorator creates.
+
+        Requires asyncio, or trollius for Python 2.
+
+        put() and get() return futures you can wait for from a coroutine:
+
+            aworker = AsyncWorker(fetch_url, concurrency=1000)
+
+            for url in urls:
+                yield From(aworker.put(url))
+
+            for url in urls:
+                page = yield From(aworker.get())
+
+        put() waits only if you set `maxsize` and there are already that
+        many items waiting for a free slot. get() returns the results in
+        the order they are completed, and raises the exception if the
+        coroutine failed. Results are kept until you get() them, so if you
+        don't care about them, use submit() instead.
+
+        Sync code can use the worker too. Call start_in_thread() to run
+        the event loop in a thread, then submit() items from any other
+        thread. It returns a concurrent.futures.Future:
+
+            aworker = AsyncWorker(fetch_url).start_in_thread()
+            future = aworker.submit(url)
+            page = future.result(timeout=10)
+            aworker.stop()
+    """
+
+    def __init__(self, func, concurrency=100, maxsize=0, loop=None):
+
+        if asyncio is None:
+            raise ImportError('AsyncWorker requires asyncio or trollius')
+
+        self.func = func
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.loop = loop
+        self.thread = None
+
+        self.running = 0         # number of coroutines currently running
+        self.waiting = deque()   # items waiting for a free slot
+        self.putters = deque()   # items waiting for space in self.waiting
+        self.results = deque()   # finished tasks not yet returned by get()
+        self.getters = deque()   # futures returned by get() not resolved yet
+
+        self.ensure_future = getattr(asyncio, 'ensure_future', None)
+        if self.ensure_future is None:
+            self.ensure_future = getattr(asyncio, 'async')
+
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
+
+
+    def start(self):
+        """
+            Bind the worker to the current event loop and return it.
+        """
+        self.get_loop()
+        return self
+
+
+    def start_in_thread(self):
+        """
+            Run a new event loop in a daemon thread and bind the worker
+            to it, so you can call submit() from sync code.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def run_loop(self):
+        # so the coroutines can find the loop with get_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+    def stop(self):
+        """
+            Stop the loop run by start_in_thread(). Noop otherwise.
+        """
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+
+    def put(self, item):
+        """
+            Schedule the item for processing. Returns a future that
+            is resolved once the item has been accepted.
+        """
+        accepted = asyncio.Future(loop=self.get_loop())
+
+        if self.maxsize and len(self.waiting) >= self.maxsize:
+            self.putters.append((item, accepted))
+        else:
+            self.schedule(item)
+            accepted.set_result(None)
+
+        return accepted
+
+
+    def get(self):
+        """
+            Returns a future resolved with the next available result.
+        """
+        future = asyncio.Future(loop=self.get_loop())
+        if self.results:
+            self.transfer(self.results.popleft(), future)
+        else:
+            self.getters.append(future)
+        return future
+
+
+    def submit(self, item):
+        """
+            Thread safe way to schedule an item from outside the loop.
+
+            Returns a concurrent.futures.Future that will hold the result.
+            The result is not available from get().
+        """
+        if Future is None:
+            raise ImportError('submit() requires concurrent.futures, '
+                              'install the "futures" package')
+        future = Future()
+        self.get_loop().call_soon_threadsafe(self.schedule, item, future)
+        return future
+
+
+    def schedule(self, item, future=None):
+        if self.running < self.concurrency:
+            self.run(item, future)
+        else:
+            self.waiting.append((item, future))
+
+
+    def run(self, item, future=None):
+
+        self.running += 1
+
+        try:
+            task = self.ensure_future(self.func(item), loop=self.loop)
+        except Exception as e:
+            task = asyncio.Future(loop=self.loop)
+            task.set_exception(e)
+
+        task.add_done_callback(partial(self.on_done, future))
+
+
+    def on_done(self, future, task):
+
+        self.running -= 1
+
+        if future is not None:
+            self.transfer(task, future)
+        elif self.getters:
+            self.transfer(task, self.getters.popleft())
+        else:
+            self.results.append(task)
+
+        if self.waiting:
+            self.run(*self.waiting.popleft())
+
+        if self.putters:
+            item, accepted = self.putters.popleft()
+            self.schedule(item)
+            accepted.set_result(None)
+
+
+    @staticmethod
+    def transfer(task, future):
+        """
+            Copy the outcome of a finished task to another future.
+        """
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+
+def aio_worker(concurrency=100, maxsize=0, loop=None):
+    """
+        Turn a coroutine function into an asyncio worker. It's the
+        counterpart of `worker` for I/O bound tasks: thousands of items can
+        be waiting on I/O at the same time, in one thread.
+
+            from batbelt.parallel import aio_worker
+
+            @aio_worker(concurrency=1000)
+            @asyncio.coroutine
+            def fetch(url):
+                ...
+
+            aworker = fetch.start()
+
+        See AsyncWorker for the API of the returned object.
+    """
+
+    def decorator(func):
 
         @wraps(func)
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
 
-        def get(block=block, timeout=timeout):
-            res = out_queue.get(block, timeout)
-            if isinstance(res, Exception):
-                raise res
-            return res
-
-        wrapper.manager = Manager(target=main_loop)
-        wrapper.manager.get = get
-        wrapper.manager.stop = lambda: in_queue.put(StopWorker(), block, timeout)
-        wrapper.manager.put = lambda x: in_queue.put(x, block, timeout)
-        wrapper.start = lambda: wrapper.manager.start() or wrapper.manager
+        wrapper.manager = AsyncWorker(func, concurrency, maxsize, loop)
+        wrapper.start = wrapper.manager.start
+        wrapper.start_in_thread = wrapper.manager.start_in_thread
 
         return wrapper
 
@@ -53,6 +53,8 @@ r"""
 
 import re
 import os
+import sys
+import string
 import codecs
 import json
 import unicodedata
@@ -79,10 +81,7 @@ def unicode_slugify(string, separator=r'-'):
         u'stuff-with-dashes-and-spaces'
     """
 
-    string = re.sub(r'[^\w\s' + separator + ']', '', string, flags=re.U)
-    string = string.strip().lower()
-    return unicode(re.sub(r'[' + separator + '\s]+',
-                   separator, string, flags=re.U))
+    return get_slugifier(separator, None)(string)
 
 
 def unicodedata_slugify(string, separator=r'-'):
@@ -99,9 +98,7 @@ def unicodedata_slugify(string, separator=r'-'):
         u'stuff-with-dashes-and-spaces'
     """
 
-    string = unicodedata.normalize('NFKD', string).encode('ascii', 'ignore')
-    string = re.sub(r'[^\w\s' + separator + ']', '', string).strip().lower()
-    return unicode(re.sub(r'[' + separator + '\s]+', separator, string))
+    return get_slugifier(separator, unicodedata_normalize)(string)
 
 
 def unidecode_slugify(string, separator=r'-'):
@@ -118,9 +115,7 @@ def unidecode_slugify(string, separator=r'-'):
         u'stuff-with-dashes-and-spaces'
     """
 
-    string = unidecode.unidecode(string)
-    string = re.sub(r'[^\w\s' + separator + ']', '', string).strip().lower()
-    return unicode(re.sub(r'[' + separator + '\s]+', separator, string))
+    return get_slugifier(separator, unidecode_normalize)(string)
 
 
 def unicodedata_normalize(string):
@@ -164,6 +159,128 @@ except ImportError:
     normalize = unicodedata_normalize
 
 
+# Normalizers working character by character, and slow enough to make it
+# worth caching their result for each character
+CACHEABLE_NORMALIZERS = (unidecode_normalize,)
+
+
+class TranslationTable(dict):
+    """
+        unicode.translate() table replacing each character with the result
+        of convert(character). There are too many unicode characters to fill
+        it in advance, so it's done the first time they are looked up.
+    """
+
+    def __init__(self, convert):
+        self.convert = convert
+
+    def __missing__(self, code):
+        value = self[code] = self.convert(unichr(code))
+        return value
+
+
+class Slugifier(object):
+    r"""
+        slugify() with everything prepared in advance for a separator and
+        a normalize function, to slugify a lot of strings fast:
+
+            >>> slugify = Slugifier('_')
+            >>> slugify(u"C'est No\xebl !")
+            u'cest_noel'
+
+        Pass normalize=None to keep the non ASCII characters, like
+        unicode_slugify().
+
+        Once the string is ASCII, characters are removed and lowered in one
+        str.translate() call, and the separators are put with split() and
+        join(), unless the string already contains some. ASCII strings skip
+        normalization, and the unidecode result is cached for each
+        character.
+
+        The slugify() functions of this module use the slugifiers returned
+        by get_slugifier(), which creates one per separator and normalize
+        function.
+    """
+
+    ASCII_TABLE = string.maketrans(string.ascii_uppercase,
+                                   string.ascii_lowercase)
+
+    def __init__(self, separator=r'-', normalize=normalize):
+        self.separator = separator
+        self.normalize = normalize
+
+        flags = re.U if normalize is None else 0
+        self.remove = re.compile(r'[^\w\s' + separator + ']', flags)
+        self.collapse = re.compile(r'[' + separator + '\s]+', flags)
+
+        # a separator which isn't one plain character may mean something
+        # else in a regex character class: we use the regexes as-is then
+        self.translatable = len(separator) == 1 and separator not in '\\[]^'
+        if not self.translatable:
+            return
+
+        self.collapse = re.compile(r'[' + re.escape(separator) + '\s]+', flags)
+
+        self.removed = ''.join(c for c in map(chr, xrange(256))
+                               if self.remove.match(c))
+        self.table = None
+        # on narrow builds, characters outside the BMP are 2 code points
+        if normalize in CACHEABLE_NORMALIZERS and sys.maxunicode > 0xffff:
+            self.table = TranslationTable(self.to_ascii)
+
+    def to_ascii(self, string):
+        """
+            Normalize, remove and lower characters, without the translation
+            table.
+        """
+        string = self.normalize(string)
+        if isinstance(string, unicode):
+            string = string.encode('ascii', 'ignore')
+        return unicode(string.translate(self.ASCII_TABLE, self.removed))
+
+    def __call__(self, string):
+        if not self.translatable:
+            return self.slugify_with_regexes(string)
+
+        if self.normalize is None:
+            string = self.remove.sub(u'', unicode(string)).lower()
+        else:
+            try:
+                string = string.encode('ascii').translate(self.ASCII_TABLE,
+                                                          self.removed)
+            except UnicodeError:
+                if self.table is not None:
+                    string = string.translate(self.table)
+                else:
+                    string = self.to_ascii(string)
+
+        if self.separator in string:
+            return unicode(self.collapse.sub(self.separator, string.strip()))
+        return unicode(self.separator.join(string.split()))
+
+    def slugify_with_regexes(self, string):
+        if self.normalize is not None:
+            string = self.normalize(string)
+        string = self.remove.sub('', string).strip().lower()
+        return unicode(self.collapse.sub(self.separator, string))
+
+
+SLUGIFIERS = {}
+
+
+def get_slugifier(separator=r'-', normalize=normalize):
+    """
+        Return a Slugifier for these parameters, created on the first call
+        and then reused.
+    """
+    try:
+        return SLUGIFIERS[separator, normalize]
+    except KeyError:
+        slugifier = SLUGIFIERS[separator, normalize] = Slugifier(separator,
+                                                                 normalize)
+        return slugifier
+
+
 def escape_html(text, additional_escape={'"': "&quot;", "'": "&apos;"}):
     """
         Turn HTML tag caracters into HTML entities.
@@ -3,61 +3,705 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 
-from collections import MutableSet, deque
+import re
+import sys
+import mmap
+import math
 
-from itertools import islice, chain
+from time import time
+from datetime import datetime, timedelta
+from operator import eq, ge, le, add, or_
+from collections import (MutableSet, Mapping, MutableMapping, Iterable,
+                         OrderedDict, deque)
+
+from itertools import islice, chain, izip, count
+
+from utils import to_timestamp
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __all__ = ['chunks', 'dmerge', 'get', 'window', 'dswap', 'subdict', 'first',
-           'first_true', 'sset']
+           'first_true', 'sset', 'skip_duplicates', 'LRUFingerprints',
+           'TTLFingerprints', 'BloomFingerprints', 'compile_path', 'parse_path',
+           'Extractor', 'extract', 'rolling_sum', 'rolling_mean',
+           'rolling_variance', 'rolling_min', 'rolling_max', 'MergedDict',
+           'dfold', 'MERGE_STRATEGIES', 'bidict', 'DuplicateValueError']
+
+
+# Types we can slice without copying through a memoryview (or buffer)
+BUFFER_TYPES = (str, bytearray, memoryview, buffer, mmap.mmap)
+
+# Types for which slicing is the fastest way to make chunks
+SLICEABLE_TYPES = (list, tuple, unicode) + BUFFER_TYPES
+
+
+def buffer_chunks(data, chunksize):
+    """
+        Yields windows of chunksize bytes on data, without copying it:
+        memoryviews, or buffers for the types that don't support
+        memoryview in Python 2, such as mmap.
+    """
+    try:
+        view = memoryview(data)
+    except TypeError:
+        # slicing a buffer returns a copy, so we create one per chunk
+        for start in xrange(0, len(data), chunksize):
+            yield buffer(data, start, chunksize)
+        return
+
+    for start in xrange(0, len(view), chunksize):
+        yield view[start:start + chunksize]
 
 
 def chunks(seq, chunksize, process=tuple):
     """
         Yields items from an iterator in iterable chunks.
+
+        :Example:
+
+            >>> list(chunks(xrange(7), 3))
+            [(0, 1, 2), (3, 4, 5), (6,)]
+
+        Lists, tuples, strings and buffers are sliced instead of iterated
+        on. With process=None, you get the slices as-is, and for binary data
+        (str, bytearray, mmap...) they are memoryviews (or buffers for
+        mmap) on the original data instead of copies:
+
+            >>> [chunk.tobytes() for chunk in chunks(b'abcdefg', 3, None)]
+            ['abc', 'def', 'g']
+
+        That's the way to go to send a huge buffer by pieces on the network.
+        Don't resize the data while you iterate over the chunks.
     """
+
+    if isinstance(seq, SLICEABLE_TYPES):
+
+        if process is None and isinstance(seq, BUFFER_TYPES):
+            for chunk in buffer_chunks(seq, chunksize):
+                yield chunk
+            return
+
+        for start in xrange(0, len(seq), chunksize):
+            chunk = seq[start:start + chunksize]
+            yield chunk if process is None else process(chunk)
+
+        return
+
+    process = process or tuple
     it = iter(seq)
     while True:
         yield process(chain([it.next()], islice(it, chunksize - 1)))
 
 
 
-def window(iterable, size=2):
+def window(iterable, size=2, step=None, key=None):
     """
         Yields iterms by bunch of a given size, but rolling only one item
         in and out at a time when iterating.
+
+        Set step to move by more than one item at a time: step=size gives
+        tumbling windows, which don't overlap.
+
+            >>> [list(w) for w in window(range(7), 3, step=2)]
+            [[0, 1, 2], [2, 3, 4], [4, 5, 6]]
+            >>> [list(w) for w in window(range(7), 3, step=3)]
+            [[0, 1, 2], [3, 4, 5]]
+
+        Windows are always full, except if the whole iterable is smaller than
+        size. Use chunks() if you want the remainder.
+
+        Pass a key to extract a timestamp (a number or a datetime) from
+        each item, and the windows become time based. size and step are
+        then durations (in seconds or as timedelta), and items must come in
+        chronological order.
+
+        Without step, you get one window per item, containing the items of
+        the last size seconds:
+
+            >>> events = [(0, 'a'), (1, 'b'), (5, 'c'), (6, 'd')]
+            >>> for w in window(events, 3, key=lambda e: e[0]):
+            ...     print [e[1] for e in w]
+            ['a']
+            ['a', 'b']
+            ['c']
+            ['c', 'd']
+
+        With a step, windows start at each multiple of step and cover size
+        seconds. A window is yielded once an item past its end is seen (or
+        the iterable is exhausted), and empty windows are skipped:
+
+            >>> for w in window(events, 4, step=4, key=lambda e: e[0]):
+            ...     print [e[1] for e in w]
+            ['a', 'b']
+            ['c', 'd']
+            >>> for w in window(events, 4, step=2, key=lambda e: e[0]):
+            ...     print [e[1] for e in w]
+            ['a', 'b']
+            ['a', 'b']
+            ['c']
+            ['c', 'd']
+            ['d']
+
+        In all cases, only the current window is kept in memory, and it's
+        the same deque that is yielded every time: copy it if you want to
+        keep it.
     """
+    if key is not None:
+        return time_window(iterable, size, step, key)
+    return count_window(iterable, size, step or 1)
+
+
+def count_window(iterable, size, step):
     iterable = iter(iterable)
     d = deque(islice(iterable, size), size)
     yield d
+
+    if len(d) < size:
+        return
+
+    if step == 1:
+        for x in iterable:
+            d.append(x)
+            yield d
+        return
+
+    hop = min(step, size)
+    skip = step - hop
+    while True:
+        if skip:
+            next(islice(iterable, skip - 1, skip), None)
+        items = list(islice(iterable, hop))
+        if len(items) < hop:
+            return
+        d.extend(items)
+        yield d
+
+
+def to_seconds(value):
+    if isinstance(value, datetime):
+        return to_timestamp(value)
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def first_window_start(stamp, size, step):
+    """
+        Smallest multiple of step for which the window contains stamp.
+    """
+    return stamp - size - (stamp - size) % step + step
+
+
+def time_window(iterable, size, step, key):
+    size = to_seconds(size)
+    d = deque()
+    stamps = deque()
+
+    if step is None:
+        for x in iterable:
+            stamp = to_seconds(key(x))
+            while stamps and stamps[0] <= stamp - size:
+                stamps.popleft()
+                d.popleft()
+            stamps.append(stamp)
+            d.append(x)
+            yield d
+        return
+
+    step = to_seconds(step)
+    start = None
+
     for x in iterable:
+        stamp = to_seconds(key(x))
+
+        if start is None:
+            start = first_window_start(stamp, size, step)
+
+        while stamp >= start + size:
+            while stamps and stamps[0] < start:
+                stamps.popleft()
+                d.popleft()
+            if d:
+                yield d
+                start += step
+            else:
+                # jump over the gap to the first window that contains stamp
+                start = max(start, first_window_start(stamp, size, step))
+
+        stamps.append(stamp)
         d.append(x)
-        yield d
 
+    while d:
+        while stamps and stamps[0] < start:
+            stamps.popleft()
+            d.popleft()
+        if d:
+            yield d
+        start += step
+
+
+def is_numpy_array(iterable):
+    return numpy is not None and isinstance(iterable, numpy.ndarray)
+
+
+def numpy_rolling_sum(array, size):
+    """
+        Sum of each window of a 1D array in linear time, using the difference
+        of cumulated sums.
+    """
+    size = min(size, len(array))
+    if not size:
+        return array[:0]
+    cumsum = numpy.concatenate(([0], array.cumsum()))
+    return cumsum[size:] - cumsum[:-size]
+
+
+def numpy_rolling_extremum(array, size, ufunc):
+    """
+        Min or max of each window of a 1D array in linear time: split the
+        array in blocks of size items, then the result for a window is the
+        best between the end of one block and the start of the next one
+        (the van Herk / Gil-Werman algorithm).
+    """
+    length = len(array)
+    size = min(size, length)
+    if not size:
+        return array[:0]
+    blocks = -(-length // size)
+    padded = numpy.concatenate(
+        (array, numpy.repeat(array[-1:], blocks * size - length)))
+    padded = padded.reshape(blocks, size)
+    prefix = ufunc.accumulate(padded, axis=1).ravel()
+    suffix = ufunc.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+    return ufunc(suffix[:length - size + 1], prefix[size - 1:length])
+
+
+def rolling_sum(iterable, size=2):
+    """
+        Yields the sum of each window of the iterable, like
+        sum(w) for w in window(iterable, size), but in O(1) for each step.
+
+        :Example:
+
+            >>> list(rolling_sum([1, 2, 3, 4, 5], 3))
+            [6, 9, 12]
+
+        If you pass a 1D numpy array, you get an array back.
+    """
+    if is_numpy_array(iterable):
+        return numpy_rolling_sum(iterable, size)
+    return iter_rolling_sum(iterable, size)
+
+
+def iter_rolling_sum(iterable, size):
+    iterable = iter(iterable)
+    d = deque(islice(iterable, size))
+    if not d:
+        return
+    total = sum(d)
+    yield total
+    for x in iterable:
+        total += x - d.popleft()
+        d.append(x)
+        yield total
+
+
+def rolling_mean(iterable, size=2):
+    """
+        Yields the mean of each window of the iterable, in O(1) for each step.
+
+        :Example:
+
+            >>> list(rolling_mean([1, 2, 3, 4, 5], 2))
+            [1.5, 2.5, 3.5, 4.5]
+
+        If you pass a 1D numpy array, you get an array back.
+    """
+    if is_numpy_array(iterable):
+        return numpy_rolling_sum(iterable, size) / float(min(size, len(iterable)) or 1)
+    return iter_rolling_mean(iterable, size)
+
+
+def iter_rolling_mean(iterable, size):
+    iterable = iter(iterable)
+    d = deque(islice(iterable, size))
+    length = float(len(d))
+    if not length:
+        return
+    total = sum(d)
+    yield total / length
+    for x in iterable:
+        total += x - d.popleft()
+        d.append(x)
+        yield total / length
+
+
+def rolling_variance(iterable, size=2, ddof=0):
+    """
+        Yields the variance of each window of the iterable, in O(1) for each
+        step, using an updated version of Welford's algorithm.
+
+        ddof works like in numpy: 0 is the population variance, 1 the
+        sample variance. If the window is not bigger than ddof, the variance
+        is nan, like with numpy.var().
+
+        :Example:
+
+            >>> list(rolling_variance([1, 3, 5, 9, 1], 2))
+            [1.0, 1.0, 4.0, 16.0]
+            >>> list(rolling_variance([1, 3, 5, 9, 1], 2, ddof=1))
+            [2.0, 2.0, 8.0, 32.0]
+
+        If you pass a 1D numpy array, you get an array back.
+    """
+    if is_numpy_array(iterable):
+        return numpy_rolling_variance(iterable, size, ddof)
+    return iter_rolling_variance(iterable, size, ddof)
+
+
+def numpy_rolling_variance(array, size, ddof):
+    # centering first keeps the difference of squares precise
+    array = array - array.mean() if len(array) else array
+    size = min(size, len(array))
+    sums = numpy_rolling_sum(array, size)
+    squares = numpy_rolling_sum(array * array, size)
+    if size - ddof <= 0:
+        return numpy.full(len(sums), numpy.nan)
+    return (squares - sums * sums / size) / float(size - ddof)
+
+
+def iter_rolling_variance(iterable, size, ddof):
+    iterable = iter(iterable)
+    d = deque(islice(iterable, size))
+    length = float(len(d))
+    if not length:
+        return
+
+    if length - ddof <= 0:
+        nan = float('nan')
+        yield nan
+        for x in iterable:
+            yield nan
+        return
+
+    mean = sum(d) / length
+    squares = sum((x - mean) ** 2 for x in d)
+    yield squares / (length - ddof)
+
+    for x in iterable:
+        old = d.popleft()
+        d.append(x)
+        old_mean = mean
+        mean += (x - old) / length
+        squares += (x - old) * (x - mean + old - old_mean)
+        yield squares / (length - ddof)
+
+
+def rolling_min(iterable, size=2):
+    """
+        Yields the smallest item of each window of the iterable, in amortized
+        O(1) for each step.
+
+        :Example:
+
+            >>> list(rolling_min([3, 1, 4, 1, 5, 9, 2, 6], 3))
+            [1, 1, 1, 1, 2, 2]
 
-def dmerge(d1, d2, merge_func=None):
+        If you pass a 1D numpy array, you get an array back.
     """
-        Create a new dictionary being the merge of the two passed as a
-        parameter. If a key is in both dictionaries, the values are processed
-        with the merge_func.
+    if is_numpy_array(iterable):
+        return numpy_rolling_extremum(iterable, size, numpy.minimum)
+    return iter_rolling_extremum(iterable, size, ge)
 
-        By default the value in the second dictionary erases the value in the
-        first one.
+
+def rolling_max(iterable, size=2):
+    """
+        Yields the biggest item of each window of the iterable, in amortized
+        O(1) for each step.
+
+        :Example:
+
+            >>> list(rolling_max([3, 1, 4, 1, 5, 9, 2, 6], 3))
+            [4, 4, 5, 9, 9, 9]
+
+        If you pass a 1D numpy array, you get an array back.
+    """
+    if is_numpy_array(iterable):
+        return numpy_rolling_extremum(iterable, size, numpy.maximum)
+    return iter_rolling_extremum(iterable, size, le)
+
+
+def iter_rolling_extremum(iterable, size, beaten):
+    """
+        Keep a deque of (index, item) where items are sorted from best to
+        worst: each new item pushes out the ones it beats from the end, and
+        the best one falls off the start when it leaves the window.
+    """
+    candidates = deque()
+    for i, x in enumerate(iterable):
+        while candidates and beaten(candidates[-1][1], x):
+            candidates.pop()
+        candidates.append((i, x))
+        if candidates[0][0] <= i - size:
+            candidates.popleft()
+        if i >= size - 1:
+            yield candidates[0][1]
+
+    if candidates and i < size - 1:
+        yield candidates[0][1]
+
+
+# Merge strategies by type: concatenate sequences, union sets, add numbers
+MERGE_STRATEGIES = {
+    list: add,
+    tuple: add,
+    set: or_,
+    frozenset: or_,
+    int: add,
+    long: add,
+    float: add,
+    complex: add,
+    bool: lambda v1, v2: v2,
+}
+
+
+def dmerge(*dicts, **kwargs):
     """
-    d = {}
+        Create a new dictionary being the merge of the ones passed as
+        parameters. If a key is in several dictionaries, the values are
+        processed with the merge_func.
+
+        By default the value in the last dictionary erases the value in the
+        previous ones.
+
+        The old dmerge(d1, d2, merge_func) signature still works, and all
+        the dicts are merged in one pass, without intermediary copies:
+
+            >>> dmerge({'a': 1}, {'b': 2}, {'a': 3})
+            {'a': 3, 'b': 2}
 
-    d.update(d1)
+        merge_func can also be a dict of {type: merge_func}. It's used when
+        both values are of the same type, otherwise the last value wins.
+        MERGE_STRATEGIES concatenates lists and tuples, unions sets and adds
+        numbers:
 
-    if merge_func is None:
-        d.update(d2)
-        return d
+            >>> dmerge({'a': [1], 'b': 1}, {'a': [2], 'b': 2},
+            ...        merge_func=MERGE_STRATEGIES)
+            {'a': [1, 2], 'b': 3}
 
-    for k, v in d2.iteritems():
-        if k in d:
-            d[k] = merge_func(d[k], v)
+        With deep=True, values that are dicts in several dicts are merged
+        recursively instead of being passed to merge_func. The original
+        dicts are never modified:
+
+            >>> dmerge({'db': {'host': 'localhost', 'port': 5432}},
+            ...        {'db': {'port': 6543}}, deep=True)
+            {'db': {'host': 'localhost', 'port': 6543}}
+
+        With lazy=True, nothing is copied: you get a MergedDict, a view
+        that looks up the keys in the original dicts when you read it.
+
+        To merge dicts coming from a generator without loading them all in
+        memory, see dfold().
+
+        A dict of strategies must be passed as merge_func=, since as a
+        positional argument it would be merged as data. Only a callable is
+        taken as merge_func when passed positionally.
+    """
+    merge_func = kwargs.pop('merge_func', None)
+    deep = kwargs.pop('deep', False)
+    lazy = kwargs.pop('lazy', False)
+    if kwargs:
+        raise TypeError("dmerge() got unexpected keyword arguments: "
+                        "%s" % ', '.join(kwargs))
+
+    # dmerge(d1, d2, merge_func)
+    if dicts and not isinstance(dicts[-1], Mapping):
+        if not callable(dicts[-1]):
+            raise TypeError("dmerge() expects dicts, and optionally a "
+                            "merge function, not a %s"
+                            % type(dicts[-1]).__name__)
+        dicts, merge_func = dicts[:-1], dicts[-1]
+
+    if lazy:
+        return MergedDict(dicts, get_merge_func(merge_func, deep))
+
+    return dfold(dicts, merge_func, deep)
+
+
+def dfold(dicts, merge_func=None, deep=False):
+    """
+        Merge all the dicts of an iterable in a new one, like dmerge() does.
+        The dicts are consumed one by one, so the iterable can be a
+        generator yielding a huge number of them:
+
+            >>> dfold(({'total': i} for i in xrange(1000)), MERGE_STRATEGIES)
+            {'total': 499500}
+    """
+    merge_func = get_merge_func(merge_func)
+    result = {}
+    owned = {}  # the nested dicts we created, by id, and can update
+    for d in dicts:
+        merge_into(result, d, merge_func, deep, owned)
+    return result
+
+
+def merge_into(target, d, merge_func, deep, owned):
+    if merge_func is None and not deep:
+        target.update(d)
+        return
+
+    for key, value in d.iteritems():
+
+        if key not in target:
+            target[key] = value
+            continue
+
+        current = target[key]
+        if deep and isinstance(current, Mapping) and isinstance(value, Mapping):
+            if id(current) not in owned:
+                current = target[key] = dict(current)
+                owned[id(current)] = current
+            merge_into(current, value, merge_func, deep, owned)
+        elif merge_func is None:
+            target[key] = value
         else:
-            d[k] = v
-    return d
+            target[key] = merge_func(current, value)
+
+
+def get_merge_func(merge_func, deep=False):
+    """
+        Turn the merge_func parameter of dmerge() into a function merging
+        2 values, or None if the last value should just win.
+    """
+    if merge_func is not None and not callable(merge_func):
+        strategies = merge_func
+
+        def merge_func(v1, v2):
+            for cls in type(v1).__mro__:
+                strategy = strategies.get(cls)
+                if strategy is not None:
+                    if isinstance(v2, cls):
+                        return strategy(v1, v2)
+                    break
+            return v2
+
+    if not deep:
+        return merge_func
+
+    def deep_merge(v1, v2):
+        if isinstance(v1, Mapping) and isinstance(v2, Mapping):
+            return dfold((v1, v2), merge_func, True)
+        if merge_func is None:
+            return v2
+        return merge_func(v1, v2)
+
+    return deep_merge
+
+
+class MergedDict(MutableMapping):
+    """
+        Dict-like view on the merge of several dicts, as returned by
+        dmerge(..., lazy=True).
+
+        Reading a key looks it up in the dicts, the last one winning. If
+        merge_func is given and several dicts have the key, their values
+        are merged with it, and the result is cached for the next reads:
+
+            >>> defaults = {'host': 'localhost', 'apps': ['admin']}
+            >>> conf = {'apps': ['blog']}
+            >>> d = MergedDict((defaults, conf), lambda a, b: a + b)
+            >>> d['host'], d['apps']
+            ('localhost', ['admin', 'blog'])
+
+        The first write (or deletion) copies everything into a real dict,
+        and the view then works with it only. The original dicts are never
+        modified, but don't modify them while you use the view: cached
+        values won't be updated.
+    """
+
+    __slots__ = ('dicts', 'merge_func', 'cache', 'data')
+
+    def __init__(self, dicts, merge_func=None):
+        self.dicts = tuple(dicts)
+        self.merge_func = merge_func
+        self.cache = {}
+        self.data = None    # the real dict, once materialized
+
+    def __getitem__(self, key):
+        if self.data is not None:
+            return self.data[key]
+
+        if self.merge_func is None:
+            for d in reversed(self.dicts):
+                if key in d:
+                    return d[key]
+            raise KeyError(key)
+
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        values = [d[key] for d in self.dicts if key in d]
+        if not values:
+            raise KeyError(key)
+        value = values[0]
+        for other in values[1:]:
+            value = self.merge_func(value, other)
+        if len(values) > 1:
+            self.cache[key] = value
+        return value
+
+    def __contains__(self, key):
+        if self.data is not None:
+            return key in self.data
+        return any(key in d for d in self.dicts)
+
+    def __iter__(self):
+        if self.data is not None:
+            return iter(self.data)
+        return self.iterkeys()
+
+    def iterkeys(self):
+        # a key is yielded when we meet it in the last dict containing it
+        dicts = self.dicts
+        for i, d in enumerate(dicts):
+            others = dicts[i + 1:]
+            for key in d:
+                if not any(key in other for other in others):
+                    yield key
+
+    def __len__(self):
+        if self.data is not None:
+            return len(self.data)
+        return sum(1 for key in self.iterkeys())
+
+    def materialize(self):
+        """
+            Copy the merge into a real dict, which will be used from now on,
+            and return it.
+        """
+        if self.data is None:
+            self.data = dict((key, self[key]) for key in self.iterkeys())
+            self.dicts = ()
+            self.cache = {}
+        return self.data
+
+    def __setitem__(self, key, value):
+        self.materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self.materialize()[key]
+
+    def copy(self):
+        return dict(self.data if self.data is not None else self)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self))
 
 
 def dswap(dct):
@@ -74,10 +718,119 @@ def dswap(dct):
 
             >>> sorted(dswap({'a': 1, 'b': 2}).items())
             [(1, 'a'), (2, 'b')]
+
+        If you need the reverse lookup more than once, use a bidict instead.
     """
     return dict((value, key) for key, value in dct.iteritems())
 
 
+class DuplicateValueError(ValueError):
+    pass
+
+
+class bidict(MutableMapping):
+    """
+        Dict that also maps each value to its key, so you can lookup in both
+        directions in O(1). Both indexes are updated on every change.
+
+            >>> codes = bidict({'fr': 33, 'uk': 44})
+            >>> codes['fr'], codes.inverse[44]
+            (33, 'uk')
+            >>> codes.inverse[1] = 'us'
+            >>> codes['us']
+            1
+
+        inverse is a bidict too, sharing the same indexes, so it doesn't
+        cost any copy.
+
+        Values must be unique and hashable. What happens when you set a
+        value that is already mapped to another key depends on
+        on_duplicate:
+
+        - 'raise' (default): raise a DuplicateValueError, nothing changes.
+        - 'overwrite': the other key is removed.
+        - 'ignore': the new item is dropped.
+
+            >>> codes['france'] = 33
+            Traceback (most recent call last):
+            ...
+            DuplicateValueError: 33 is already the value of 'fr'
+            >>> codes = bidict(codes, on_duplicate='overwrite')
+            >>> codes['france'] = 33
+            >>> sorted(codes.items())
+            [('france', 33), ('uk', 44), ('us', 1)]
+    """
+
+    __slots__ = ('forward', 'backward', 'on_duplicate')
+
+    POLICIES = ('raise', 'overwrite', 'ignore')
+
+    def __init__(self, data=(), on_duplicate='raise', **kwargs):
+        if on_duplicate not in self.POLICIES:
+            raise ValueError('on_duplicate must be one of %s, not %r' % (
+                             ', '.join(self.POLICIES), on_duplicate))
+        self.forward = {}
+        self.backward = {}
+        self.on_duplicate = on_duplicate
+        self.update(data, **kwargs)
+
+    @property
+    def inverse(self):
+        inverse = bidict.__new__(self.__class__)
+        inverse.forward = self.backward
+        inverse.backward = self.forward
+        inverse.on_duplicate = self.on_duplicate
+        return inverse
+
+    def __getitem__(self, key):
+        return self.forward[key]
+
+    def __contains__(self, key):
+        return key in self.forward
+
+    def __iter__(self):
+        return iter(self.forward)
+
+    def __len__(self):
+        return len(self.forward)
+
+    def __setitem__(self, key, value):
+        forward, backward = self.forward, self.backward
+
+        if value in backward:
+            owner = backward[value]
+            if owner == key:
+                return
+            if self.on_duplicate == 'raise':
+                raise DuplicateValueError('%r is already the value of %r' % (
+                                          value, owner))
+            if self.on_duplicate == 'ignore':
+                return
+            del forward[owner]
+
+        if key in forward:
+            del backward[forward[key]]
+
+        forward[key] = value
+        backward[value] = key
+
+    def __delitem__(self, key):
+        del self.backward[self.forward.pop(key)]
+
+    def clear(self):
+        self.forward.clear()
+        self.backward.clear()
+
+    def copy(self):
+        return self.__class__(self.forward, self.on_duplicate)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.forward)
+
+    def __reduce__(self):
+        return self.__class__, (self.forward, self.on_duplicate)
+
+
 def get(data, *keys, **kwargs):
     """
         Extract a data from nested mapping and sequences using a list of keys
@@ -105,6 +858,119 @@ def get(data, *keys, **kwargs):
     return value
 
 
+# Tokens of the string syntax of compile_path()
+PATH_TOKEN = re.compile(r"""
+    \.?([^.\[\]'"]+)     # name, at the start or after a dot
+    | \[(-?\d+)\]        # [index]
+    | \[(['"])(.*?)\3\]   # ['key'] or ["key"]
+""", re.VERBOSE)
+
+
+def parse_path(path):
+    """
+        Turn a string describing a path into the keys to apply successively.
+
+        :Example:
+
+            >>> parse_path("a[0].b['c.d']")
+            ('a', 0, 'b', 'c.d')
+
+        Names are keys, numbers in brackets are indices, and you can quote
+        a key in brackets if it contains dots or brackets.
+    """
+    keys = []
+    position = 0
+    while position < len(path):
+        match = PATH_TOKEN.match(path, position)
+        if not match:
+            raise ValueError('Invalid path "%s" at position %s' % (path,
+                                                                   position))
+        name, index, quote, quoted = match.groups()
+        if name is not None:
+            keys.append(name)
+        elif index is not None:
+            keys.append(int(index))
+        else:
+            keys.append(quoted)
+        position = match.end()
+    return tuple(keys)
+
+
+# Cache of the functions created by compile_path() and compile_attr_path()
+COMPILED_PATHS = {}
+MAX_COMPILED_PATHS = 10000
+
+
+def compile_accessor(template, kind, path, default):
+    """
+        Return a function applying the given path of keys or attributes to
+        its argument, created by filling the template for this exact path.
+        The functions are cached.
+    """
+
+    try:
+        cache_key = (kind, path, type(default), default)
+        accessor = COMPILED_PATHS.get(cache_key)
+    except TypeError:  # unhashable default value
+        cache_key = accessor = None
+
+    if accessor is not None:
+        return accessor
+
+    namespace = {'default': default}
+    accessors = []
+    for i, step in enumerate(path):
+        name = 'step%s' % i
+        namespace[name] = step
+        accessors.append(name)
+
+    exec(template(accessors, path), namespace)
+    accessor = namespace['accessor']
+    accessor.path = path
+
+    if cache_key is not None:
+        if len(COMPILED_PATHS) >= MAX_COMPILED_PATHS:
+            COMPILED_PATHS.clear()
+        COMPILED_PATHS[cache_key] = accessor
+
+    return accessor
+
+
+def get_template(names, path):
+    if not names:  # same as get(data)
+        return 'def accessor(data):\n    return default\n'
+    return ('def accessor(data):\n'
+            '    try:\n'
+            '        return data[%s]\n'
+            '    except (KeyError, IndexError, TypeError):\n'
+            '        return default\n') % ']['.join(names)
+
+
+def compile_path(*keys, **kwargs):
+    """
+        Return a function doing the same as get(data, *keys, **kwargs)
+        but faster, since the function is generated for this exact path,
+        and cached.
+
+        :Example:
+
+            >>> getter = compile_path('test', 0, 'bla', default="yeah")
+            >>> getter({'test': [{'bla': 1}]})
+            1
+            >>> getter({})
+            'yeah'
+
+        If you pass only one string, it's parsed with parse_path(), so this
+        is the same:
+
+            >>> getter = compile_path('test[0].bla', default="yeah")
+    """
+    if len(keys) == 1 and isinstance(keys[0], basestring):
+        keys = parse_path(keys[0])
+    return compile_accessor(get_template, 'get', keys,
+                            kwargs.get('default', None))
+
+
 def iget(data, value, default=None):
     """
         Same as indexing, but works with any iterable,
@@ -168,6 +1034,110 @@ def unpack(indexable, *args, **kwargs):
 
 
 
+class Extractor(object):
+    """
+        Extract the values of several paths from nested mappings and
+        sequences in one go, like calling get() for each path, but
+        walking the common parts of the paths only once.
+
+        Paths are tuples of keys, or strings parsed with parse_path().
+        The default value is `default`, unless the path is in `defaults`.
+
+        :Example:
+
+            >>> extract = Extractor('user.name', 'user.emails[0]', ('id',),
+            ...                     defaults={'user.emails[0]': ''})
+            >>> extract({'id': 1, 'user': {'name': 'bob', 'emails': []}})
+            ['bob', '', 1]
+
+        Use map() to get a generator extracting the values from an
+        iterable of records:
+
+            for name, email, id in extract.map(records):
+                ...
+    """
+
+    def __init__(self, *paths, **kwargs):
+
+        default = kwargs.get('default', None)
+        defaults = kwargs.get('defaults', {})
+
+        self.paths = []
+        self.defaults = []
+
+        # {key: [{child key: ...}, [indexes of the paths ending here]]}
+        trie = {}
+
+        for i, path in enumerate(paths):
+
+            self.defaults.append(defaults.get(path, default))
+
+            if isinstance(path, basestring):
+                path = parse_path(path)
+            self.paths.append(path)
+
+            children = trie
+            for key in path:
+                node = children.setdefault(key, [{}, []])
+                children = node[0]
+            if path:
+                node[1].append(i)
+
+        self.trie = self.freeze(trie)
+
+
+    @classmethod
+    def freeze(cls, trie):
+        """
+            Turn the trie into nested lists of (key, indexes, children),
+            which are faster to iterate on.
+        """
+        return [(key, ends, cls.freeze(children))
+                for key, (children, ends) in trie.iteritems()]
+
+
+    def __call__(self, data):
+        """
+            Return the list of values for all paths.
+        """
+        results = list(self.defaults)
+        stack = [(self.trie, data)]
+        while stack:
+            children, value = stack.pop()
+            for key, ends, grandchildren in children:
+                try:
+                    child = value[key]
+                except (KeyError, IndexError, TypeError):
+                    continue
+                for i in ends:
+                    results[i] = child
+                if grandchildren:
+                    stack.append((grandchildren, child))
+        return results
+
+
+    def map(self, records):
+        """
+            Return a generator yielding the list of values for each record.
+        """
+        for record in records:
+            yield self(record)
+
+
+
+def extract(data, *paths, **kwargs):
+    """
+        Shortcut for Extractor(*paths, **kwargs)(data).
+
+        :Example:
+
+            >>> extract({'a': {'b': 1, 'c': [2]}}, 'a.b', 'a.c[0]', 'z')
+            [1, 2, None]
+    """
+    return Extractor(*paths, **kwargs)(data)
+
+
+
 def subdict(dct, include=(), exclude=()):
     """
         Return a dictionary that is a copy of the given one.
@@ -213,7 +1183,7 @@ def first_true(iterable, key=lambda x: x, default=None):
     return default
 
 
-def skip_duplicates(iterable, key=lambda x: x):
+def skip_duplicates(iterable, key=lambda x: x, fingerprints=None):
     """
         Returns a generator that will yield all objects from iterable, skipping
         duplicates.
@@ -260,6 +1230,25 @@ def skip_duplicates(iterable, key=lambda x: x):
             >>> list(skip_duplicates([Test(), Test(), Test('other')], lambda x: x.foo))
             [Test('bar'), Test('other')]
 
+        All fingerprints are kept in memory, which is a problem with
+        endless streams. Pass `fingerprints` to choose how they are stored:
+
+            - LRUFingerprints(max_size) : forget the least recently seen
+                                          ones once there are max_size.
+            - TTLFingerprints(ttl) : forget the ones seen more than ttl
+                                     seconds ago.
+            - BloomFingerprints(capacity, error_rate) : fixed memory, but a
+                                     small rate of elements are wrongly
+                                     seen as duplicates.
+
+        :Example:
+
+            >>> seen = LRUFingerprints(2)
+            >>> list(skip_duplicates([1, 2, 1, 3, 1, 2], fingerprints=seen))
+            [1, 2, 3, 2]
+            >>> seen.hits, seen.misses
+            (2, 4)
+
         See also :
             - strip_duplicates : a simpler, slower function that returns a list
                                  of elements with no duplicates. It accepts
@@ -267,14 +1256,21 @@ def skip_duplicates(iterable, key=lambda x: x):
           - remove_duplicates : remove duplicates from a list in place.
                                 Most ressource efficient merthod.
     """
-    fingerprints = set()
 
     try:
-        for x in iterable:
-            fingerprint = key(x)
-            if fingerprint not in fingerprints:
-                yield x
-                fingerprints.add(fingerprint)
+        if fingerprints is None:
+            fingerprints = set()
+            for x in iterable:
+                fingerprint = key(x)
+                if fingerprint not in fingerprints:
+                    yield x
+                    fingerprints.add(fingerprint)
+        else:
+            seen = fingerprints.seen
+            for x in iterable:
+                fingerprint = key(x)
+                if not seen(fingerprint):
+                    yield x
     except TypeError as e:
         try:
             hash(fingerprint)
@@ -292,7 +1288,258 @@ def skip_duplicates(iterable, key=lambda x: x):
 
 
 
-def strip_duplicates(iterable, equals=lambda x, y: x == y):
+class Fingerprints(object):
+    """
+        Base class for the fingerprint stores of skip_duplicates.
+
+        Subclasses implement seen(), which records the fingerprint and
+        tells if it was already there, and memory().
+    """
+
+    def __init__(self):
+        self.hits = 0    # fingerprints seen before
+        self.misses = 0  # new fingerprints
+
+
+    def seen(self, fingerprint):
+        raise NotImplementedError()
+
+
+    def memory(self):
+        """
+            Approximate size in bytes of the store. Only the containers are
+            counted, not the fingerprints themselves.
+        """
+        raise NotImplementedError()
+
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.
+
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'memory': self.memory(),
+        }
+
+
+
+class LRUFingerprints(Fingerprints):
+    """
+        Keep the `max_size` most recently seen fingerprints.
+    """
+
+    def __init__(self, max_size):
+        super(LRUFingerprints, self).__init__()
+        self.max_size = max_size
+        self.fingerprints = OrderedDict()
+
+
+    def seen(self, fingerprint):
+
+        fingerprints = self.fingerprints
+
+        if fingerprint in fingerprints:
+            # move it to the end
+            fingerprints[fingerprint] = fingerprints.pop(fingerprint)
+            self.hits += 1
+            return True
+
+        fingerprints[fingerprint] = None
+        if len(fingerprints) > self.max_size:
+            fingerprints.popitem(last=False)
+        self.misses += 1
+        return False
+
+
+    def memory(self):
+        # The Python OrderedDict keeps a second dict, mapping each key to
+        # its [prev, next, key] link, on top of the mapping itself
+        fingerprints = self.fingerprints
+        links = getattr(fingerprints, '_OrderedDict__map', {})
+        return (sys.getsizeof(fingerprints) + sys.getsizeof(links) +
+                len(links) * sys.getsizeof([None] * 3))
+
+
+
+class TTLFingerprints(Fingerprints):
+    """
+        Keep the fingerprints for `ttl` seconds after they are first seen.
+
+        `clock` is the function returning the current time, and defaults
+        to time.time. Pass something else if the elements carry their own
+        timestamp.
+    """
+
+    def __init__(self, ttl, clock=time):
+        super(TTLFingerprints, self).__init__()
+        self.ttl = ttl
+        self.clock = clock
+        self.fingerprints = {}
+        self.timeline = deque()  # (timestamp, fingerprint), oldest first
+
+
+    def seen(self, fingerprint):
+
+        now = self.clock()
+        limit = now - self.ttl
+        fingerprints = self.fingerprints
+        timeline = self.timeline
+
+        while timeline and timeline[0][0] <= limit:
+            del fingerprints[timeline.popleft()[1]]
+
+        if fingerprint in fingerprints:
+            self.hits += 1
+            return True
+
+        fingerprints[fingerprint] = now
+        timeline.append((now, fingerprint))
+        self.misses += 1
+        return False
+
+
+    def memory(self):
+        return (sys.getsizeof(self.fingerprints) +
+                sys.getsizeof(self.timeline) +
+                len(self.timeline) * sys.getsizeof((None, None)))
+
+
+
+class BloomFingerprints(Fingerprints):
+    """
+        Store fingerprints in a Bloom filter: memory is fixed, but about
+        `error_rate` of the new fingerprints will be wrongly reported as
+        seen once `capacity` fingerprints have been stored. Above that,
+        the error rate grows quickly.
+
+        1 billion fingerprints with an error rate of 0.1% take about 1.7Go.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        super(BloomFingerprints, self).__init__()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+                                       math.log(2))))
+        self.bits = bytearray(self.size // 8 + 1)
+
+
+    def seen(self, fingerprint):
+
+        # Mix the bits of hash() (murmur3 finalizer) since hash(int) is the
+        # int itself, then derive all the hashes from 2 of them.
+        h = hash(fingerprint) & 0xffffffffffffffff
+        h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & 0xffffffffffffffff
+        h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & 0xffffffffffffffff
+        h ^= h >> 33
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+
+        bits = self.bits
+        size = self.size
+        found = True
+        for i in xrange(self.hashes):
+            position = (h1 + i * h2) % size
+            byte = position >> 3
+            mask = 1 << (position & 7)
+            if not bits[byte] & mask:
+                found = False
+                bits[byte] |= mask
+
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+
+    def memory(self):
+        return sys.getsizeof(self.bits)
+
+
+    def stats(self):
+        stats = super(BloomFingerprints, self).stats()
+        # error rate for the number of fingerprints actually stored
+        stats['error_rate'] = (1 - math.exp(-self.hashes * self.misses /
+                                            float(self.size))) ** self.hashes
+        return stats
+
+
+
+# Types for which equality and hash are consistent, so we can use a set to
+# find duplicates instead of comparing all elements. Subclasses and other types
+# may redefine __eq__ without __hash__ and are compared one by one.
+HASH_SAFE_TYPES = frozenset((int, long, float, complex, bool, str, unicode,
+                             type(None)))
+
+
+def has_safe_hash(obj):
+    """
+        Return True if obj can be put in a set to find its duplicates
+        without changing the result of equality comparisons.
+
+        NaN is not safe: it's not equal to itself, but sets check identity
+        before equality.
+    """
+    cls = obj.__class__
+    if cls in HASH_SAFE_TYPES:
+        return (cls is not float and cls is not complex) or obj == obj
+    if cls is tuple or cls is frozenset:
+        return all(has_safe_hash(x) for x in obj)
+    return False
+
+
+def iter_strip_duplicates(iterable, equals=eq):
+    """
+        Yield elements from iterable, skipping the ones equal to a previous
+        one. This is the engine of strip_duplicates and remove_duplicates.
+
+        With the default `equals`, elements of types listed in
+        HASH_SAFE_TYPES are looked up in a set, and the others are compared
+        with all the unique elements so far, like with a custom `equals`.
+    """
+
+    if equals is not eq:
+        uniques = []
+        for x in iterable:
+            for elem in uniques:
+                if equals(elem, x):
+                    break
+            else:
+                uniques.append(x)
+                yield x
+        return
+
+    hashed = set()
+    others = []  # unique elements not in hashed
+
+    for x in iterable:
+
+        if has_safe_hash(x):
+            if x in hashed:
+                continue
+            if others and any(elem == x for elem in others):
+                continue
+            hashed.add(x)
+
+        else:
+            if any(elem == x for elem in others):
+                continue
+            if any(elem == x for elem in hashed):
+                continue
+            others.append(x)
+
+        yield x
+
+
+def strip_duplicates(iterable, equals=eq):
     """
         Return a list of elements from iterable, without duplicates.
 
@@ -317,6 +1564,11 @@ def strip_duplicates(iterable, equals=lambda x, y: x == y):
             >>> strip_duplicates([Test(), Test(), Test('other')])
             [Test('bar'), Test('other')]
 
+        Primitives such as int, str or tuple of them are deduplicated
+        using a set, other elements are compared one by one, so lists of
+        primitives are processed in O(n), and the rest in O(n * m), m being
+        the number of unique elements.
+
         See also :
           - skip_duplicates : returns a generator yielding elements without
                               duplicates. Faster, works on infinite iterables,
@@ -324,31 +1576,20 @@ def strip_duplicates(iterable, equals=lambda x, y: x == y):
           - remove_duplicates : remove duplicates from a list in place.
                                 Most ressource efficient merthod.
     """
+    return list(iter_strip_duplicates(iterable, equals))
 
-    iterable = iter(iterable)
 
-    res = []
-    while True:
-
-        try:
-            elem = next(iterable)
-        except StopIteration:
-            break
-
-        res.append(elem)
-
-        iterable = iter([x for x in iterable if not equals(elem, x)])
-
-    return res
-
-
-def remove_duplicates(lst, equals=lambda x, y: x == y):
+def remove_duplicates(lst, equals=eq):
     """
         Removes duplicates from a list, in place.
 
         Works only with lists and modifies the list, but it's pretty ressource
         saving compared to other methods.
 
+        Unique elements are moved toward the beginning of the list as they
+        are found, then the end of the list is truncated once, so no element
+        is shifted more than once.
+
         See also :
           - skip_duplicates : returns a generator yielding elements without
                               duplicates. Faster, works on infinite iterables,
@@ -361,42 +1602,55 @@ def remove_duplicates(lst, equals=lambda x, y: x == y):
     if not isinstance(lst, list):
         raise TypeError('This function works only with lists.')
 
-    i1 = 0
-    l = (len(lst) - 1)
+    # we only write at positions the iteration already went through
+    write = 0
+    for x in iter_strip_duplicates(lst, equals):
+        lst[write] = x
+        write += 1
 
-    while i1 < l:
-
-        elem = lst[i1]
-
-        i2 = i1 + 1
-        while i2 <= l:
-            if equals(elem, lst[i2]):
-                del lst[i2]
-                l -= 1
-            i2 += 1
-
-        i1 += 1
+    del lst[write:]
 
     return lst
 
 
 
-KEY, PREV, NEXT = range(3)
+# Marks the place of a removed element in sset.items
+HOLE = object()
 
 
 class sset(MutableSet):
     """
         Set that preserves ordering.
 
-        From http://code.activestate.com/recipes/576694/
+        Elements are stored in a list in insertion order, and a dict maps
+        each of them to its position in the list. Removing an element
+        leaves a hole in the list, and the list is compacted once half
+        of it is holes. There are no reference cycles, so the garbage
+        collector has nothing to do with it.
+
+        It has the same methods as set(), working directly on the list
+        and the dict instead of adding and removing elements one by one.
+        Elements from the other iterables are added in their order, after
+        the ones of the sset. The only exception is `&`, which keeps
+        the order of the right operand, as it did with MutableSet.
+
+        Like with the linked list it used to be, you can add and discard
+        elements while iterating over it: discarded elements are skipped,
+        and added ones are yielded. The list is not compacted until the
+        iterations are over. Other changes while iterating, such as
+        intersection_update(), give undefined results.
     """
 
+    __slots__ = ('map', 'items', 'holes', 'start', 'iterators')
+
     def __init__(self, iterable=None):
-        self.end = end = []
-        end += [None, end, end]         # sentinel node for doubly linked list
-        self.map = {}                   # key --> [key, prev, next]
+        self.map = {}       # key --> position in self.items
+        self.items = []
+        self.holes = 0
+        self.start = 0      # there are only holes before this position
+        self.iterators = 0  # number of running iterations
         if iterable is not None:
-            self |= iterable
+            self.update(iterable)
 
     def __len__(self):
         return len(self.map)
@@ -406,34 +1660,217 @@ class sset(MutableSet):
 
     def add(self, key):
         if key not in self.map:
-            end = self.end
-            curr = end[PREV]
-            curr[NEXT] = end[PREV] = self.map[key] = [key, curr, end]
+            self.map[key] = len(self.items)
+            self.items.append(key)
 
     def discard(self, key):
         if key in self.map:
-            key, prev, next = self.map.pop(key)
-            prev[NEXT] = next
-            next[PREV] = prev
+            self.items[self.map.pop(key)] = HOLE
+            self.holes += 1
+            if (self.holes > 8 and self.holes * 2 > len(self.items) and
+               not self.iterators):
+                self.compact()
+
+    def compact(self):
+        """
+            Remove the holes in self.items.
+        """
+        self.items = items = [x for x in self.items if x is not HOLE]
+        map = self.map
+        for i, key in enumerate(items):
+            map[key] = i
+        self.holes = self.start = 0
+
+    def rebuild(self, items):
+        """
+            Replace the content of the sset with the list of `items`,
+            which must not contain duplicates.
+        """
+        self.items = items
+        self.map = dict(izip(items, count()))
+        self.holes = self.start = 0
+
+    def copy(self):
+        new = self.__class__()
+        if self.holes:
+            new.rebuild(list(self))
+        else:
+            new.items = list(self.items)
+            new.map = self.map.copy()
+        return new
+
+    __copy__ = copy
+
+    @staticmethod
+    def as_set(iterable):
+        """
+            Return the iterable if it has a fast __contains__, or a set of it.
+        """
+        if isinstance(iterable, (sset, set, frozenset, dict)):
+            return iterable
+        return set(iterable)
+
+    def update(self, *iterables):
+        map = self.map
+        items = self.items
+        append = items.append
+        for iterable in iterables:
+            position = len(items)
+            for key in iterable:
+                if key not in map:
+                    map[key] = position
+                    append(key)
+                    position += 1
+
+    def intersect(self, iterables):
+        """
+            List of the elements of the sset that are in all the iterables.
+        """
+        items = list(self)
+        for iterable in iterables:
+            other = self.as_set(iterable)
+            items = [x for x in items if x in other]
+        return items
+
+    def intersection_update(self, *iterables):
+        self.rebuild(self.intersect(iterables))
+
+    def difference_update(self, *iterables):
+        for iterable in iterables:
+            if iterable is self:
+                self.clear()
+            elif len(self) and hasattr(iterable, '__len__') and \
+                    len(iterable) * 8 < len(self):
+                # few elements to remove, no need to rebuild everything
+                for key in iterable:
+                    self.discard(key)
+            else:
+                other = self.as_set(iterable)
+                self.rebuild([x for x in self if x not in other])
+
+    def symmetric_difference_update(self, iterable):
+        if iterable is self:
+            return self.clear()
+        if not isinstance(iterable, (sset, set, frozenset, dict)):
+            iterable = sset(iterable)
+        map = self.map
+        self.rebuild([x for x in self if x not in iterable] +
+                     [x for x in iterable if x not in map])
+
+    def union(self, *iterables):
+        new = self.copy()
+        new.update(*iterables)
+        return new
+
+    def intersection(self, *iterables):
+        new = self.__class__()
+        new.rebuild(self.intersect(iterables))
+        return new
+
+    def difference(self, *iterables):
+        new = self.copy()
+        new.difference_update(*iterables)
+        return new
+
+    def symmetric_difference(self, iterable):
+        new = self.copy()
+        new.symmetric_difference_update(iterable)
+        return new
+
+    def issubset(self, iterable):
+        other = self.as_set(iterable)
+        return len(self) <= len(other) and all(x in other for x in self)
+
+    def issuperset(self, iterable):
+        map = self.map
+        return all(x in map for x in iterable)
+
+    def __or__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.union(other)
+
+    def __and__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        # like for MutableSet, the order is the one of `other`
+        if not isinstance(other, sset):
+            other = sset(other)
+        new = self.__class__()
+        new.rebuild([x for x in other if x in self.map])
+        return new
+
+    def __sub__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.difference(other)
+
+    def __xor__(self, other):
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return self.symmetric_difference(other)
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def clear(self):
+        self.map.clear()
+        del self.items[:]
+        self.holes = self.start = 0
 
     def __iter__(self):
-        end = self.end
-        curr = end[NEXT]
-        while curr is not end:
-            yield curr[KEY]
-            curr = curr[NEXT]
+        self.iterators += 1
+        try:
+            for x in islice(self.items, self.start, None):
+                if x is not HOLE:
+                    yield x
+        finally:
+            self.iterators -= 1
 
     def __reversed__(self):
-        end = self.end
-        curr = end[PREV]
-        while curr is not end:
-            yield curr[KEY]
-            curr = curr[PREV]
+        self.iterators += 1
+        try:
+            for x in reversed(self.items):
+                if x is not HOLE:
+                    yield x
+        finally:
+            self.iterators -= 1
 
     def pop(self, last=True):
+
         if not self:
             raise KeyError('set is empty')
-        key = next(reversed(self)) if last else next(iter(self))
+
+        items = self.items
+
+        if last:
+            key = items.pop()
+            while key is HOLE:
+                self.holes -= 1
+                key = items.pop()
+            del self.map[key]
+            return key
+
+        while items[self.start] is HOLE:
+            self.start += 1
+        key = items[self.start]
         self.discard(key)
         return key
 
@@ -443,13 +1880,61 @@ class sset(MutableSet):
         return '%s(%r)' % (self.__class__.__name__, list(self))
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, sset):
-            return len(self) == len(other) and list(self) == list(other)
+            if len(self) != len(other):
+                return False
+            if not self.holes and not other.holes:
+                return self.items == other.items
+            return list(self) == list(other)
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and self.map.viewkeys() == other
         return set(self) == set(other)
 
-    def __del__(self):
-        self.clear()   # remove circular references
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+
 
+def identity(x):
+    return x
+
+
+
+def is_char(obj):
+    """
+        True for one character strings, which iterate on themselves.
+    """
+    return isinstance(obj, basestring) and len(obj) == 1
+
+
+# Decision for the string classes to flatten
+STRING = object()
+
+
+# Depth from which Flattener checks that it's not going round in circles.
+# A structure containing itself repeats itself along the path, so there is
+# no need to check the containers above.
+CYCLE_CHECK_DEPTH = 100
+
+
+def enter(container, depth, max_depth, path, on_path):
+    """
+        Check that Flattener can go into this container, and add it to the
+        path (keeping it referenced keeps the ids unique).
+    """
+    if depth >= max_depth:
+        raise RuntimeError('Maximum depth of %s reached while flattening'
+                           % max_depth)
+    if id(container) in on_path:
+        raise RuntimeError('Cannot flatten a %s containing itself'
+                           % container.__class__.__name__)
+    on_path.add(id(container))
+    path.append(container)
 
 
 class Flattener(object):
@@ -457,9 +1942,10 @@ class Flattener(object):
         Create a flattener that you can call on a deeply nested data
         structures to iterate over the items as it if it were a flat iterable.
 
-        The flattener returns a generator that lazily yield the items and
-        deals with up to hundred of levels of nesting (~800 on my machine,
-        and you can control it with sys.setrecursionlimit).
+        The flattener returns a generator that lazily yield the items. It
+        uses a stack of iterators instead of recursion, so there is no limit
+        to the levels of nesting unless you set max_depth, and yielding an
+        item costs the same whatever its depth.
 
         A default flattener named 'flatten' is available by default.
 
@@ -502,6 +1988,16 @@ class Flattener(object):
 
             [0, u'a', 1.0, u'b', u'c', 3.0, 1, u'a', 1.0, u'b', u'c', 3.0]
 
+        Unless you override should_flatten() or transform_iterable(), the
+        decision to flatten an object and how to iterate on it is made once
+        per class, then cached. The cache is reset at each call if
+        flatten_types or iterable_getters changed, but not if you register
+        a class to an ABC in flatten_types after the first call.
+
+        If you flatten strings, one character strings are yielded as-is,
+        since they contain themselves. Other structures containing
+        themselves raise a RuntimeError instead of going on forever, as
+        does going deeper than max_depth levels if you set it.
     """
 
     DEFAULT_FLATTEN_TYPES = (
@@ -516,9 +2012,49 @@ class Flattener(object):
     )
 
 
-    def __init__(self, flatten_types=None, iterable_getters={}):
+    def __init__(self, flatten_types=None, iterable_getters={},
+                 max_depth=None):
         self.flatten_types = flatten_types or self.DEFAULT_FLATTEN_TYPES
         self.iterable_getters = iterable_getters
+        self.max_depth = max_depth
+
+        # class -> None if it should not be flatten, or a function returning
+        # the iterable to flatten
+        self.decisions = {}
+        self.string_getters = {}
+        self.cached_types = None
+        self.cached_getters = None
+
+
+    def get_decisions(self):
+        """
+            Return the decision cache, emptied if the settings changed since
+            it was filled.
+        """
+        if (self.flatten_types != self.cached_types or
+           self.iterable_getters != self.cached_getters):
+            self.decisions = {}
+            self.string_getters = {}
+            self.cached_types = self.flatten_types
+            self.cached_getters = dict(self.iterable_getters)
+        return self.decisions
+
+
+    def decide(self, obj):
+        """
+            Fill the decision cache for the class of this object.
+        """
+        cls = obj.__class__
+        if self.should_flatten(obj):
+            getter = self.iterable_getters.get(cls, identity)
+            # strings need a check for each object, see __call__()
+            if issubclass(cls, basestring):
+                self.string_getters[cls] = getter
+                getter = STRING
+        else:
+            getter = None
+        self.decisions[cls] = getter
+        return getter
 
 
     def should_flatten(self, obj):
@@ -558,12 +2094,60 @@ class Flattener(object):
             Returns a generator yieling items from a deeply nested iterable
             like it would be a flat one.
         """
-        for e in iterable:
-            if self.should_flatten(e):
-                for f in self(self.transform_iterable(e)):
-                    yield f
-            else:
+        stack = [iter(iterable)]
+        max_depth = self.max_depth or float('inf')
+        check_depth = min(CYCLE_CHECK_DEPTH, max_depth)
+        # the containers deeper than check_depth, and their ids
+        path = []
+        on_path = set()
+
+        cls = self.__class__
+        if (cls.should_flatten != Flattener.should_flatten or
+           cls.transform_iterable != Flattener.transform_iterable):
+
+            should_flatten = self.should_flatten
+            transform_iterable = self.transform_iterable
+
+            while stack:
+                for e in stack[-1]:
+                    if should_flatten(e) and not is_char(e):
+                        if len(stack) >= check_depth:
+                            enter(e, len(stack), max_depth, path, on_path)
+                        # go deeper, we'll resume this level when exhausted
+                        stack.append(iter(transform_iterable(e)))
+                        break
+                    yield e
+                else:
+                    stack.pop()
+                    if len(stack) >= check_depth:
+                        on_path.remove(id(path.pop()))
+
+            return
+
+        decisions = self.get_decisions()
+        decide = self.decide
+
+        while stack:
+            for e in stack[-1]:
+                try:
+                    getter = decisions[e.__class__]
+                except KeyError:
+                    getter = decide(e)
+                if getter is not None:
+                    if getter is STRING:
+                        if len(e) == 1:
+                            yield e
+                            continue
+                        getter = self.string_getters[e.__class__]
+                    if len(stack) >= check_depth:
+                        enter(e, len(stack), max_depth, path, on_path)
+                    stack.append(iter(getter(e)))
+                    break
                 yield e
+            else:
+                stack.pop()
+                if len(stack) >= check_depth:
+                    on_path.remove(id(path.pop()))
 
 
 
@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""
+    Benchmarks of the batbelt hot paths, to spot regressions between
+    releases.
+
+    Run them from anywhere, they use the batbelt of this repository:
+
+        python benchmarks/bench.py                      # sizes 10^3 to 10^5
+        python benchmarks/bench.py --max-size 10000000  # up to 10^7
+        python benchmarks/bench.py -k sset -k chunks    # only some of them
+        python benchmarks/bench.py -o baseline.json     # save the results
+        python benchmarks/bench.py -c baseline.json     # compare with them
+
+    Each benchmark is run for each size in a forked process, so its memory
+    peak is not polluted by the others. The peak is the max RSS reached
+    while running the benchmark, minus the RSS once its input is built. On
+    Linux, the max RSS is reset after building the input, so the peak is
+    exact. Elsewhere, the max RSS can't be reset, so if building the input
+    used more memory than the run, the run doesn't show up: the peak is
+    then a lower bound, and is printed with a "~". Some benchmarks have a
+    max size, past which they would take minutes.
+
+    Benchmarks needing an optional dependency (numpy, asyncio or trollius)
+    are skipped when it's not installed.
+
+    The sset benchmarks have a linked_set counterpart, running the linked
+    list recipe sset used to be. Their build benchmark also prints the
+    bytes used by the set for each element, not counting the elements.
+
+    Results are printed as a table, and saved as JSON with -o. With -c, the
+    time ratio with the baseline is printed as well, and the exit status is
+    1 if a benchmark got slower than --threshold.
+"""
+
+from __future__ import division
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import timeit
+import resource
+import argparse
+import platform
+import traceback
+import multiprocessing
+
+from datetime import datetime
+from collections import OrderedDict, deque
+from itertools import izip
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batbelt
+
+from batbelt.structs import (chunks, window, rolling_sum, rolling_mean,
+                             rolling_variance, rolling_min, rolling_max,
+                             flatten, skip_duplicates, strip_duplicates,
+                             remove_duplicates, LRUFingerprints,
+                             TTLFingerprints, BloomFingerprints, sset,
+                             dmerge, dfold, bidict, get, Extractor,
+                             compile_path, MERGE_STRATEGIES)
+from batbelt.objects import attr, compile_attr_path
+from batbelt.strings import slugify, json_dumps, json_loads
+from batbelt.parallel import (worker, pmap, process, thread, aio_worker,
+                              asyncio)
+
+import linked_set
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+BENCHMARKS = OrderedDict()
+
+consume = deque(maxlen=0).extend
+
+
+def benchmark(max_size=10 ** 7, requires=True):
+    """
+        Register a benchmark. The decorated function gets the size of the
+        input, prepares it, and returns the function to time. It can also
+        return (function, bytes) to report the memory used by the data
+        structure it benchmarks.
+
+        If requires is false (e.g: the optional module it needs is None),
+        the benchmark is not registered.
+    """
+    def decorator(setup):
+        if requires:
+            BENCHMARKS[setup.__name__] = (setup, max_size)
+        return setup
+    return decorator
+
+
+@benchmark()
+def chunks_list(n):
+    data = range(n)
+    return lambda: consume(chunks(data, 100))
+
+
+@benchmark()
+def chunks_iterator(n):
+    return lambda: consume(chunks(xrange(n), 100))
+
+
+@benchmark()
+def chunks_buffer(n):
+    data = bytearray(n)
+    return lambda: consume(chunks(data, 4096, None))
+
+
+@benchmark()
+def window_count(n):
+    return lambda: consume(window(xrange(n), 10))
+
+
+@benchmark()
+def window_time(n):
+    events = [(i, i // 3) for i in xrange(n)]
+    return lambda: consume(window(events, 100, 10, key=lambda e: e[1]))
+
+
+@benchmark()
+def rolling_sum_iter(n):
+    data = [random.random() for i in xrange(n)]
+    return lambda: consume(rolling_sum(data, 100))
+
+
+@benchmark()
+def rolling_mean_iter(n):
+    data = [random.random() for i in xrange(n)]
+    return lambda: consume(rolling_mean(data, 100))
+
+
+@benchmark()
+def rolling_variance_iter(n):
+    data = [random.random() for i in xrange(n)]
+    return lambda: consume(rolling_variance(data, 100, ddof=1))
+
+
+@benchmark()
+def rolling_min_iter(n):
+    data = [random.random() for i in xrange(n)]
+    return lambda: consume(rolling_min(data, 100))
+
+
+@benchmark()
+def rolling_max_iter(n):
+    data = [random.random() for i in xrange(n)]
+    return lambda: consume(rolling_max(data, 100))
+
+
+@benchmark(requires=numpy)
+def rolling_numpy(n):
+    data = numpy.random.RandomState(0).random_sample(n)
+    return lambda: (rolling_sum(data, 100), rolling_variance(data, 100),
+                    rolling_min(data, 100))
+
+
+@benchmark()
+def flatten_nested(n):
+    data = [[i, (i, [i, 'foo'])] for i in xrange(n // 4)]
+    return lambda: consume(flatten(data))
+
+
+@benchmark()
+def skip_duplicates_set(n):
+    data = [random.randint(0, n // 2) for i in xrange(n)]
+    return lambda: consume(skip_duplicates(data))
+
+
+@benchmark()
+def skip_duplicates_bloom(n):
+    data = [random.randint(0, n // 2) for i in xrange(n)]
+    return lambda: consume(skip_duplicates(
+        data, fingerprints=BloomFingerprints(n)))
+
+
+@benchmark()
+def skip_duplicates_lru(n):
+    data = [random.randint(0, n // 2) for i in xrange(n)]
+    return lambda: consume(skip_duplicates(
+        data, fingerprints=LRUFingerprints(n // 10)))
+
+
+@benchmark()
+def skip_duplicates_ttl(n):
+    data = [random.randint(0, n // 2) for i in xrange(n)]
+    return lambda: consume(skip_duplicates(
+        data, fingerprints=TTLFingerprints(60)))
+
+
+@benchmark()
+def strip_duplicates_ints(n):
+    data = [random.randint(0, n // 2) for i in xrange(n)]
+    return lambda: strip_duplicates(data)
+
+
+@benchmark()
+def remove_duplicates_ints(n):
+    # it works in place, so the time includes copying the list
+    data = [random.randint(0, n // 2) for i in xrange(n)]
+    return lambda: remove_duplicates(list(data))
+
+
+def sset_sizeof(s):
+    return sys.getsizeof(s) + sys.getsizeof(s.map) + sys.getsizeof(s.items)
+
+
+def set_benchmarks(prefix, cls, sizeof):
+    """
+        Register the benchmarks of an ordered set class.
+    """
+
+    def build(n):
+        data = range(n)
+        return (lambda: cls(data)), sizeof(cls(data))
+
+    def add(n):
+
+        def run():
+            s = cls()
+            add = s.add
+            for x in data:
+                add(x)
+
+        data = range(n)
+        return run
+
+    def discard(n):
+        # add them back, so the set is the same for the next run
+        data = range(n)
+        random.shuffle(data)
+        s = cls(data)
+
+        def run():
+            for x in data:
+                s.discard(x)
+            for x in data:
+                s.add(x)
+
+        return run
+
+    def iterate(n):
+        s = cls(xrange(n))
+        for x in xrange(0, n, 3):
+            s.discard(x)
+        return lambda: consume(s)
+
+    for setup in (build, add, discard, iterate):
+        setup.__name__ = '%s_%s' % (prefix, setup.__name__)
+        benchmark(max_size=10 ** 6)(setup)
+
+
+set_benchmarks('sset', sset, sset_sizeof)
+set_benchmarks('linked_set', linked_set.LinkedSet, linked_set.sizeof)
+
+
+@benchmark(max_size=10 ** 6)
+def sset_operations(n):
+    s1 = sset(xrange(n))
+    s2 = sset(xrange(n // 2, n + n // 2))
+    return lambda: (s1 | s2, s1 & s2, s1 - s2, s1 ^ s2)
+
+
+@benchmark(max_size=10 ** 6)
+def dmerge_nway(n):
+    dicts = [dict((j, {'v': [i]}) for j in xrange(i * n // 20, i * n // 20 + n // 10))
+             for i in xrange(10)]
+    return lambda: dmerge(*dicts, deep=True, merge_func=MERGE_STRATEGIES)
+
+
+@benchmark(max_size=10 ** 6)
+def dmerge_lazy(n):
+    dicts = [dict((j, i) for j in xrange(i * n // 20, i * n // 20 + n // 10))
+             for i in xrange(10)]
+    keys = range(n // 20 * 9 + n // 10)
+
+    def run():
+        merged = dmerge(*dicts, lazy=True, merge_func=MERGE_STRATEGIES)
+        consume(merged[key] for key in keys)
+
+    return run
+
+
+@benchmark()
+def dfold_generator(n):
+    return lambda: dfold(({'total': i, i % 100: i} for i in xrange(n)),
+                         MERGE_STRATEGIES)
+
+
+@benchmark(max_size=10 ** 6)
+def bidict_build(n):
+    return lambda: bidict(izip(xrange(n), xrange(n)))
+
+
+@benchmark(max_size=10 ** 6)
+def extractor_map(n):
+    records = [{'user': {'name': 'bob', 'id': i}, 'tags': [i]} for i in xrange(n)]
+    extract = Extractor('user.name', 'user.id', 'tags[0]')
+    return lambda: consume(extract.map(records))
+
+
+@benchmark(max_size=10 ** 6)
+def get_nested(n):
+    records = [{'user': {'name': 'bob', 'id': i}} for i in xrange(n)]
+    return lambda: consume(get(record, 'user', 'id') for record in records)
+
+
+@benchmark(max_size=10 ** 6)
+def compile_path_get(n):
+    records = [{'user': {'name': 'bob', 'id': i}} for i in xrange(n)]
+    get_id = compile_path('user', 'id')
+    return lambda: consume(get_id(record) for record in records)
+
+
+class Record(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@benchmark(max_size=10 ** 6)
+def attr_chain(n):
+    records = [Record(user=Record(name='bob', id=i)) for i in xrange(n)]
+    return lambda: consume(attr(record, 'user', 'id') for record in records)
+
+
+@benchmark(max_size=10 ** 6)
+def compile_attr_path_get(n):
+    records = [Record(user=Record(name='bob', id=i)) for i in xrange(n)]
+    get_id = compile_attr_path('user.id')
+    return lambda: consume(get_id(record) for record in records)
+
+
+@benchmark(max_size=10 ** 5)
+def slugify_strings(n):
+    words = [u"C'est No\xebl", u'H\xe9ll\xf8 W\xc3\xb6rld', u'Foo  bar !']
+    data = [random.choice(words) for i in xrange(n)]
+    return lambda: consume(slugify(s) for s in data)
+
+
+@benchmark(max_size=10 ** 6)
+def json_dumps_records(n):
+    now = datetime.now()
+    data = [{'id': i, 'date': now, 'name': 'foo'} for i in xrange(n)]
+    return lambda: json_dumps(data)
+
+
+@benchmark(max_size=10 ** 6)
+def json_loads_records(n):
+    now = datetime.now()
+    string = json_dumps([{'id': i, 'date': now, 'name': 'foo'}
+                         for i in xrange(n)])
+    return lambda: json_loads(string)
+
+
+def double(x):
+    return x * 2
+
+
+@benchmark(max_size=10 ** 6)
+def parallel_pmap(n):
+    return lambda: pmap(double, xrange(n), size=2)
+
+
+@benchmark(max_size=10 ** 5)
+def parallel_worker(n):
+
+    def run():
+        process = worker(batch_size=100)(double).start()
+        process.put_many(xrange(n))
+        process.get_many(n)
+        process.stop()
+        process.join()
+
+    return run
+
+
+@benchmark(max_size=10 ** 4)
+def parallel_process(n):
+    call = process(pool_size=2)(double)
+    call(0).result()  # start the pool before timing
+
+    return lambda: [res.result() for res in map(call, xrange(n))]
+
+
+@benchmark(max_size=10 ** 5)
+def parallel_thread(n):
+    call = thread(pool_size=2)(double)
+    call(0).result()
+
+    return lambda: [res.result() for res in map(call, xrange(n))]
+
+
+if asyncio is not None:
+
+    @asyncio.coroutine
+    def aio_double(x):
+        return x * 2
+
+
+@benchmark(max_size=10 ** 5, requires=asyncio)
+def parallel_aio_worker(n):
+    aworker = aio_worker(concurrency=100)(aio_double).start_in_thread()
+    aworker.submit(0).result()
+
+    return lambda: [f.result() for f in map(aworker.submit, xrange(n))]
+
+
+def proc_status(field):
+    """
+        Value in KB of a field of /proc/self/status, or None if there is no
+        such file (we are not on Linux).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def reset_max_rss():
+    """
+        Set the max RSS of this process to its current RSS, and return the
+        latter. Return None if it's not possible (needs Linux 4.0).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return None
+    return proc_status('VmRSS')
+
+
+def max_rss():
+    """
+        Peak resident memory of this process, in KB.
+    """
+    rss = proc_status('VmHWM')
+    if rss is not None:
+        return rss
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss // 1024
+    return rss
+
+
+def measure(name, size, repeat, min_time):
+    """
+        Time the benchmark, running it in a loop long enough to last at
+        least min_time, and keep the best time out of repeat loops.
+    """
+    setup, max_size = BENCHMARKS[name]
+    random.seed(0)
+    run = setup(size)
+    structure_bytes = None
+    if isinstance(run, tuple):
+        run, structure_bytes = run
+    gc.collect()
+    # without a reset, the max RSS may come from the setup
+    before = reset_max_rss()
+    exact = before is not None
+    if not exact:
+        before = max_rss()
+
+    timer = timeit.default_timer
+    start = timer()
+    run()
+    duration = timer() - start
+    number = max(1, int(min_time / max(duration, 1e-9)))
+
+    timings = [duration]
+    for i in xrange(repeat - 1):
+        start = timer()
+        for j in xrange(number):
+            run()
+        timings.append((timer() - start) / number)
+
+    result = {
+        'name': name,
+        'size': size,
+        'time': min(timings),
+        'number': number,
+        'repeat': repeat,
+        'peak_kb': max_rss() - before,
+        'peak_exact': exact
+    }
+    if structure_bytes is not None:
+        result['bytes_per_item'] = structure_bytes / size
+    return result
+
+
+def measure_in_child(connection, *args):
+    try:
+        connection.send(measure(*args))
+    except Exception:
+        connection.send({'error': traceback.format_exc()})
+
+
+def run_isolated(name, size, repeat, min_time):
+    receiver, sender = multiprocessing.Pipe(False)
+    child = multiprocessing.Process(target=measure_in_child,
+                                    args=(sender, name, size, repeat, min_time))
+    child.start()
+    result = receiver.recv()
+    child.join()
+    if 'error' in result:
+        result.update(name=name, size=size)
+    return result
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '%.3g%s' % (seconds * scale, unit)
+    return '%.3gns' % (seconds * 1e9)
+
+
+def compare(results, baseline, threshold):
+    """
+        Add the ratio with the baseline times to the results, and return
+        the ones which got slower than threshold.
+    """
+    reference = dict(((r['name'], r['size']), r)
+                     for r in baseline['results'] if 'time' in r)
+    regressions = []
+    for result in results:
+        old = reference.get((result['name'], result['size']))
+        if old is None or 'time' not in result:
+            continue
+        result['ratio'] = result['time'] / old['time']
+        if result['ratio'] > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def print_result(result):
+    line = '%-24s %9s' % (result['name'], result['size'])
+    if 'error' in result:
+        print line, 'ERROR'
+        print result['error']
+        return
+    peak = '%sKB' % result['peak_kb']
+    if not result.get('peak_exact', True):
+        peak = '~' + peak
+    line += ' %10s %12s' % (format_time(result['time']), peak)
+    if 'ratio' in result:
+        line += ' %7.2fx' % result['ratio']
+    if 'bytes_per_item' in result:
+        line += ' (%.1f bytes/item)' % result['bytes_per_item']
+    print line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-k', '--keyword', action='append', default=[],
+                        help='only run benchmarks with this in their name')
+    parser.add_argument('--sizes', type=lambda s: map(int, s.split(',')),
+                        help='comma separated list of input sizes')
+    parser.add_argument('--max-size', type=int, default=10 ** 5,
+                        help='run sizes 10^3, 10^4... up to this one')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of each timing loop')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('-c', '--compare', help='baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='max time ratio with the baseline')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the benchmarks and exit')
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS
+             if not args.keyword or any(k in name for k in args.keyword)]
+
+    if args.list:
+        for name in names:
+            print name
+        return 0
+
+    sizes = args.sizes or [10 ** e for e in xrange(3, 8)
+                           if 10 ** e <= args.max_size]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    header = '%-24s %9s %10s %12s' % ('benchmark', 'size', 'time', 'memory')
+    if baseline is not None:
+        header += ' %8s' % 'ratio'
+    print header
+
+    results = []
+    for name in names:
+        for size in sizes:
+            if size > BENCHMARKS[name][1]:
+                continue
+            result = run_isolated(name, size, args.repeat, args.min_time)
+            if baseline is not None:
+                compare([result], baseline, args.threshold)
+            print_result(result)
+            results.append(result)
+            sys.stdout.flush()
+
+    report = {
+        'batbelt': batbelt.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print '\n%s benchmarks are more than %sx slower than the baseline:' % (
+                len(regressions), args.threshold)
+            for result in regressions:
+                print_result(result)
+            return 1
+
+    if any('error' in result for result in results):
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())